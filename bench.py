@@ -0,0 +1,275 @@
+"""Benchmarks of parsing, writing, transforms, collision, slicing and generation.
+
+Maps are synthesized (see `make_group_map()`), so results depend only on the options
+and are reproducible. Connectors are named "crates", so when no room fits, doorway is
+closed with a plug (see `make_plug()` and `map_gen_v2.tile_candidates()`) and every
+generation finishes, benchmark fails if it doesn't. Results are saved as JSON, compare them before and after a change:
+
+    python bench.py --tiles 200 --out before.json
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import instrument
+import map_gen_v2 as g
+import map_parser as p
+import tile_cache
+
+TEXTURES = ["CRETE4_FLR03", "LAB1_DOOR2B", "C1A0_W1", "OUT_GRND1", "{FENCE"]
+HEADER = '{\n"classname" "worldspawn"\n"mapversion" "220"\n"wad" "\\half-life\\valve\\halflife.wad"\n'
+
+ROOM_SIZE = 512
+ROOM_SPACING = ROOM_SIZE + 256 # further than slicing merges groups
+WALL = 16
+DOOR = 128 # width of doorways and connectors
+
+
+def box(x0, y0, z0, x1, y1, z1, texture):
+    """Axis aligned brush in Valve220 format"""
+    faces = [
+        ((x0, y1, z1), (x1, y1, z1), (x1, y0, z1), "1 0 0", "0 -1 0"),
+        ((x0, y0, z0), (x1, y0, z0), (x1, y1, z0), "1 0 0", "0 -1 0"),
+        ((x0, y1, z1), (x0, y0, z1), (x0, y0, z0), "0 1 0", "0 0 -1"),
+        ((x1, y0, z1), (x1, y1, z1), (x1, y1, z0), "0 1 0", "0 0 -1"),
+        ((x1, y1, z1), (x0, y1, z1), (x0, y1, z0), "1 0 0", "0 0 -1"),
+        ((x0, y0, z1), (x1, y0, z1), (x1, y0, z0), "1 0 0", "0 0 -1"),
+    ]
+    lines = []
+    for *points, u, v in faces:
+        points = " ".join(f"( {x} {y} {z} )" for x, y, z in points)
+        lines.append(f"{points} {texture} [ {u} 0 ] [ {v} 0 ] 0 1 1 ")
+    return "{\n" + "\n".join(lines) + "\n}\n"
+
+
+def make_room(ox, oy, angles, rnd, brushes=8, entities=2, start=False):
+    """Square room centered at (ox, oy) with connectors on sides given by `angles`.
+
+    Returns (worldspawn brushes, entities) as text
+    """
+    h = ROOM_SIZE // 2
+    d = DOOR // 2
+    world = [box(ox - h, oy - h, -16, ox + h, oy + h, 0, rnd.choice(TEXTURES))]
+    # walls, with doorway in the middle of sides with connectors
+    walls = {
+        180: ((ox - h, oy - h, ox - h + WALL, oy + h), (ox - h, oy - d, ox - h + WALL, oy + d)),
+        0: ((ox + h - WALL, oy - h, ox + h, oy + h), (ox + h - WALL, oy - d, ox + h, oy + d)),
+        270: ((ox - h + WALL, oy - h, ox + h - WALL, oy - h + WALL), (ox - d, oy - h, ox + d, oy - h + WALL)),
+        90: ((ox - h + WALL, oy + h - WALL, ox + h - WALL, oy + h), (ox - d, oy + h - WALL, ox + d, oy + h)),
+    }
+    for angle, ((x0, y0, x1, y1), (dx0, dy0, dx1, dy1)) in walls.items():
+        if angle not in angles:
+            world.append(box(x0, y0, 0, x1, y1, 256, rnd.choice(TEXTURES)))
+        elif angle in (0, 180):
+            world.append(box(x0, y0, 0, x1, dy0, 256, rnd.choice(TEXTURES)))
+            world.append(box(x0, dy1, 0, x1, y1, 256, rnd.choice(TEXTURES)))
+        else:
+            world.append(box(x0, y0, 0, dx0, y1, 256, rnd.choice(TEXTURES)))
+            world.append(box(dx1, y0, 0, x1, y1, 256, rnd.choice(TEXTURES)))
+    # small boxes inside of the room
+    for _ in range(max(0, brushes - len(world))):
+        x = ox + rnd.randrange(-h + 32, h - 64, 16)
+        y = oy + rnd.randrange(-h + 32, h - 64, 16)
+        world.append(box(x, y, 0, x + 32, y + 32, rnd.choice([16, 32, 64]), rnd.choice(TEXTURES)))
+
+    ents = []
+    for angle in angles:
+        # connector lies on the edge of the room, so it matches connector of a neighbour room
+        dx, dy = {0: (1, 0), 90: (0, 1), 180: (-1, 0), 270: (0, -1)}[angle]
+        ents.append(connector(ox + dx * h, oy + dy * h, angle))
+    for i in range(entities):
+        x = ox + rnd.randrange(-h + 32, h - 32)
+        y = oy + rnd.randrange(-h + 32, h - 32)
+        ents.append(f'{{\n"classname" "light"\n"origin" "{x} {y} 128"\n"targetname" "light{i}"\n}}\n')
+    if start:
+        ents.append(f'{{\n"classname" "info_player_start"\n"origin" "{ox} {oy} 36"\n"angles" "0 0 0"\n}}\n')
+    return world, ents
+
+
+def connector(cx, cy, angle):
+    sx, sy = (8, DOOR // 2) if angle in (0, 180) else (DOOR // 2, 8)
+    return ('{\n"classname" "info_connector"\n"name" "crates"\n'
+            f'"angles" "0 {angle} 0"\n'
+            + box(cx - sx, cy - sy, 0, cx + sx, cy + sy, 128, "AAATRIGGER") + "}\n")
+
+
+def make_plug():
+    """Tile that closes doorway of a room, connector faces the doorway it fills"""
+    return HEADER + box(-WALL, -DOOR // 2, 0, 0, DOOR // 2, 256, "C1A0_W1") + "}\n" + connector(0, 0, 180)
+
+
+def make_group_map(tiles, brushes=8, entities=2, connectors=3, seed=1):
+    """Group-map with `tiles` rooms: one start room, some cap rooms (single connector)
+    and rooms with up to `connectors` connectors
+    """
+    rnd = random.Random(seed)
+    cols = max(1, int(tiles ** 0.5))
+    world, ents = [], []
+    for i in range(tiles):
+        if i == 0:
+            angles = [0, 90]
+        elif i % 4 == 1:
+            angles = [rnd.choice([0, 90, 180, 270])]
+        else:
+            angles = rnd.sample([0, 90, 180, 270], rnd.randint(min(2, connectors), connectors))
+        w, e = make_room((i % cols) * ROOM_SPACING, (i // cols) * ROOM_SPACING, angles, rnd,
+                         brushes, entities, start=i == 0)
+        world += w
+        ents += e
+    return HEADER + "".join(world) + "}\n" + "".join(ents)
+
+
+def make_workdir(path, args):
+    """Files `load_generator_tiles()` expects"""
+    files = {
+        "tiles/empty.map": HEADER + "}\n",
+        "tiles/test_group_tileset2.map": make_group_map(args.tiles, args.brushes, args.entities, args.connectors, args.seed),
+        "tilesets/simple/crates_empty.map": make_plug(),
+    }
+    for name, text in files.items():
+        (path / name).parent.mkdir(parents=True, exist_ok=True)
+        (path / name).write_text(text)
+
+
+def measure(func, repeat):
+    """Runs `func` `repeat` times, returns best and mean time"""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return {"best": round(min(times), 6), "mean": round(sum(times) / len(times), 6), "repeat": repeat}
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=Path(__file__).parent).stdout.strip()
+    except OSError:
+        return None
+
+
+def run(args):
+    results = {}
+
+    def bench(name, func, repeat=args.repeat):
+        results[name] = measure(func, repeat)
+        print(f'{name:<28} best {results[name]["best"]:>9.4f}s  mean {results[name]["mean"]:>9.4f}s')
+
+    text = Path("tiles/test_group_tileset2.map").read_text()
+    map_ = p.parse_map(text)
+    brushes = g.gather_brushes(map_, ignore_connector=False)
+    info = {
+        "brushes": len(brushes),
+        "entities": len(map_.entities),
+        "connectors": len(g.get_connectors(map_)),
+        "size": len(text),
+    }
+    print("map:", info)
+
+    bench("parse_map", lambda: p.parse_map(text))
+    bench("Map.text", map_.text)
+    bench("Map.write", lambda: map_.write("bench.map"))
+    os.remove("bench.map")
+
+    lazy_map = p.parse_map(text, lazy=True)
+    bench("parse_map lazy", lambda: p.parse_map(text, lazy=True))
+    bench("Map.text lazy", lazy_map.text)
+
+    def move_brushes():
+        for brush in brushes:
+            brush.move([16, -32, 8])
+
+    def rotate_brushes():
+        for brush in brushes:
+            brush.rotate(90)
+
+    bench("Brush.move", move_brushes)
+    bench("Brush.rotate", rotate_brushes)
+    bench("Map.transform", lambda: map_.transform(90, [16, -32, 8]))
+
+    bench("slice_map_into_tiles", lambda: g.slice_map_into_tiles(p.parse_map(text)))
+    tiles = list(g.slice_map_into_tiles(p.parse_map(text)))
+
+    # every tile placed at random spot of the whole group-map
+    root = g.RootMap([p.parse_map(text).worldspawn])
+    rnd = random.Random(args.seed)
+    (min_x, max_x), (min_y, max_y), _ = g.union_bbox(g.min_max(b) for b in root.worldspawn.brushes)
+    placements = [
+        g.Placement(tile).rotate(rnd.choice([0, 90, 180, 270]))
+                         .move([rnd.uniform(min_x, max_x), rnd.uniform(min_y, max_y), 0])
+        for tile in tiles
+    ]
+
+    def intersect():
+        for placement in placements:
+            g.is_tile_intersect(root, placement)
+
+    bench("is_tile_intersect", intersect)
+    bench("load_generator_tiles", g.load_generator_tiles, 1)
+    generator_tiles = g.load_generator_tiles()
+
+    generation = {}
+    for seed in args.seeds:
+        start = time.perf_counter()
+        success, tile_stats = g.generate(seed, generator_tiles, "bench.map")
+        generation[seed] = {"time": round(time.perf_counter() - start, 6), "success": success, "tiles": len(tile_stats)}
+        print(f'generate {seed:<19} {generation[seed]["time"]:>14.4f}s  tiles={len(tile_stats)} success={success}')
+    os.remove("bench.map")
+
+    return {"map": info, "results": results, "generate": generation}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks map parser and generator on synthesized maps")
+    parser.add_argument("--tiles", type=int, default=100, help="number of tiles in group-map")
+    parser.add_argument("--brushes", type=int, default=12, help="brushes per tile")
+    parser.add_argument("--entities", type=int, default=4, help="point entities per tile")
+    parser.add_argument("--connectors", type=int, default=3, help="max connectors per tile (2-4)")
+    parser.add_argument("--seeds", type=int, nargs="+", default=[1, 2, 3, 4, 5], help="generation seeds")
+    parser.add_argument("--seed", type=int, default=1, help="seed of synthesized maps")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--out", type=Path, default=Path("bench.json"), help="file for results")
+    args = parser.parse_args()
+    args.out = args.out.resolve()
+
+    # measure the code, not the cache, instrumentation or logging
+    tile_cache.ENABLED = False
+    instrument.ENABLED = False
+    logging.disable(logging.WARNING)
+
+    with tempfile.TemporaryDirectory() as workdir:
+        cwd = os.getcwd()
+        os.chdir(workdir)
+        try:
+            make_workdir(Path(workdir), args)
+            report = run(args)
+        finally:
+            os.chdir(cwd)
+
+    report["options"] = {k: v for k, v in vars(args).items() if k != "out"}
+    report["revision"] = git_revision()
+    report["python"] = sys.version.split()[0]
+    report["platform"] = platform.platform()
+    report["date"] = time.strftime("%Y-%m-%d %H:%M:%S")
+
+    with open(args.out, "w") as f:
+        json.dump(report, f, indent=2)
+    print("Results saved to", args.out)
+
+    # time of aborted generation isn't comparable
+    failed = [seed for seed, result in report["generate"].items() if not result["success"]]
+    if failed:
+        sys.exit(f"generation failed for seeds: {', '.join(map(str, failed))}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+"""Checks that incremental slicing gives the same tiles as slicing the whole map.
+
+Group-map is synthesized (see `bench.make_group_map()`) or given with `--map` and randomly edited: brushes and
+entities are added, deleted, moved or swapped. Every edited map is sliced with
+`reslice_map_into_tiles()` reusing tiles of the original map and with `slice_map_into_tiles()`:
+
+    python check_slicing.py --edits 300
+"""
+import argparse
+import logging
+import os
+import random
+import sys
+import tempfile
+from pathlib import Path
+
+import bench
+import map_gen_v2 as g
+import map_parser as p
+import tile_cache
+
+
+def random_box(rnd, bbox):
+    (min_x, max_x), (min_y, max_y), _ = bbox
+    x = rnd.randrange(int(min_x), int(max_x), 16)
+    y = rnd.randrange(int(min_y), int(max_y), 16)
+    # mostly small brushes, sometimes long ones which join several rooms
+    sx, sy = rnd.choice([(32, 32), (64, 16), (bench.ROOM_SPACING * 2, 16), (16, bench.ROOM_SPACING * 3)])
+    return p.parse_map(bench.HEADER + bench.box(x, y, 0, x + sx, y + sy, 64, "C1A0_W1") + "}\n").worldspawn.brushes[0]
+
+
+def edit(map_, rnd, bbox):
+    """Applies random edit to `map_`, returns its name"""
+    brushes = map_.worldspawn.brushes
+    entities = map_.entities
+    op = rnd.choice(["add brush", "delete brush", "move brush", "swap brushes",
+                     "add entity", "delete entity", "move entity"])
+    if op == "add brush":
+        brushes.insert(rnd.randrange(len(brushes) + 1), random_box(rnd, bbox))
+    elif op == "delete brush":
+        brushes.pop(rnd.randrange(len(brushes)))
+    elif op == "move brush":
+        rnd.choice(brushes).move([rnd.choice([-256, -16, 8, 64, 512]), rnd.choice([0, 32, -300]), 0])
+    elif op == "swap brushes":
+        i, j = rnd.sample(range(len(brushes)), 2)
+        brushes[i], brushes[j] = brushes[j], brushes[i]
+    elif op == "add entity":
+        (min_x, max_x), (min_y, max_y), _ = bbox
+        entities.append(p.Entity({"classname": "light",
+                                  "origin": f"{rnd.uniform(min_x, max_x):.0f} {rnd.uniform(min_y, max_y):.0f} 64"}))
+    elif op == "delete entity":
+        entities.pop(rnd.randrange(len(entities)))
+    elif op == "move entity":
+        ent = rnd.choice(entities)
+        if len(ent.brushes) > 0:
+            ent.move([rnd.choice([-512, 16, 256]), 0, 0])
+        else:
+            ent.move_params([0, rnd.choice([-512, 16, 256]), 0])
+    return op
+
+
+def run(args):
+    text = (args.map or Path("tiles/test_group_tileset2.map")).read_text()
+    map_ = p.parse_map(text, lazy=args.lazy)
+    previous = g.with_brush_indexes(map_, g.slice_map_into_tiles(map_))
+    bbox = g.union_bbox(g.min_max(b) for b in map_.worldspawn.brushes)
+    print("tiles:", len(previous))
+
+    rnd = random.Random(args.seed)
+    failed = 0
+    for i in range(args.edits):
+        edited = p.parse_map(text)
+        ops = [edit(edited, rnd, bbox) for _ in range(rnd.choice([1, 1, 2, 4]))]
+        edited_text = edited.text()
+
+        expected = [tile.text() for tile in g.slice_map_into_tiles(p.parse_map(edited_text, lazy=args.lazy))]
+        resliced = g.reslice_map_into_tiles(p.parse_map(edited_text, lazy=args.lazy), previous)
+        got = [tile.text() for tile, _ in resliced]
+        if got != expected:
+            failed += 1
+            print(f"edit {i} ({', '.join(ops)}): {len(expected)} tiles expected, {len(got)} sliced incrementally")
+
+    print(f"{args.edits - failed} of {args.edits} edits sliced the same")
+    return failed == 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compares incremental and full slicing of randomly edited group-maps")
+    parser.add_argument("--edits", type=int, default=300, help="number of edited maps")
+    parser.add_argument("--tiles", type=int, default=30, help="number of tiles in group-map")
+    parser.add_argument("--seed", type=int, default=1, help="seed of synthesized map and edits")
+    parser.add_argument("--map", type=Path, help="group-map to edit instead of synthesized one")
+    parser.add_argument("--lazy", action="store_true", help="parse maps lazily (see `map_gen_v2.LAZY_PARSING`)")
+    args = parser.parse_args()
+    args.brushes, args.entities, args.connectors = 12, 4, 3
+    if args.map is not None:
+        args.map = args.map.resolve()
+
+    tile_cache.ENABLED = False
+    # random entities are often left outside of tiles, that is expected here
+    logging.disable(logging.ERROR)
+
+    with tempfile.TemporaryDirectory() as workdir:
+        cwd = os.getcwd()
+        os.chdir(workdir)
+        try:
+            bench.make_workdir(Path(workdir), args)
+            ok = run(args)
+        finally:
+            os.chdir(cwd)
+
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+"""Optional instrumentation of map generation: time spent in phases and counters.
+
+Disabled by default. When disabled `timer()` returns a shared no-op context manager
+and counters return right away, so instrumented code runs at full speed.
+"""
+import json
+import time
+from collections import defaultdict
+from contextlib import nullcontext
+
+ENABLED = False
+
+_NULL_TIMER = nullcontext()
+
+timings = defaultdict(float) # phase -> seconds
+calls = defaultdict(int)     # phase -> number of times phase was entered
+counters = defaultdict(int)
+tiles = defaultdict(lambda: defaultdict(int)) # tile name -> event (attempt, placed, rejection reason) -> count
+
+
+class _Timer:
+    __slots__ = ('phase', 'start')
+
+    def __init__(self, phase):
+        self.phase = phase
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        timings[self.phase] += time.perf_counter() - self.start
+        calls[self.phase] += 1
+
+
+def timer(phase):
+    """Context manager that adds time spent in it to `phase`"""
+    if not ENABLED:
+        return _NULL_TIMER
+    return _Timer(phase)
+
+
+def count(name, n=1):
+    if ENABLED:
+        counters[name] += n
+
+
+def tile_event(tile_name, event):
+    """Counts `event` (e.g. "attempt", "placed" or reason of rejection) for tile"""
+    if ENABLED:
+        tiles[tile_name][event] += 1
+
+
+def reset():
+    timings.clear()
+    calls.clear()
+    counters.clear()
+    tiles.clear()
+
+
+def report():
+    """Everything gathered since last `reset()` as plain dict"""
+    return {
+        "phases": {
+            phase: {"time": round(timings[phase], 6), "calls": calls[phase]}
+            for phase in sorted(timings, key=timings.get, reverse=True)
+        },
+        "counters": dict(counters),
+        "tiles": {name: dict(events) for name, events in sorted(tiles.items())},
+    }
+
+
+def write_json(path, data=None):
+    with open(path, "w") as f:
+        json.dump(report() if data is None else data, f, indent=2)
@@ -1,24 +1,42 @@
+import argparse
+import cProfile
 import copy
+import json
+import logging
 import random
 import os
 import time
 from pathlib import Path
-from collections import Counter, defaultdict
+from collections import Counter, defaultdict, namedtuple
+from bisect import bisect_left
+from itertools import chain, combinations, repeat
+from concurrent.futures import ProcessPoolExecutor
 
 import map_parser as p
+import instrument
+import tile_cache
+
+log = logging.getLogger(__name__)
 
 TILE_LIMIT = 19
 LOCK_SEED = False
 BOUNDARY_LIMIT = 4000 # True limit is 4096, but this prevents placing cap tiles
 OVERRIDE_SEED = 0#436750099
+INCREMENTAL_SLICING = True # re-slice only changed tiles of group-map
+LAZY_PARSING = False # decode brushes of tiles only when they are transformed, untouched brushes are written as they were read
+BACKTRACK_DEPTH = 3 # number of last placed tiles that can be replaced when no tile fits
+BACKTRACK_LIMIT = 50 # max number of replaced tiles per map
+CONNECTOR_PRECISION = 1 # connectors closer than that (decimal digits) are at the same spot
+EXACT_COLLISION = True # when bounding boxes of brushes overlap, check their actual shapes (see `is_hull_intersect()`)
+HULL_EPSILON = 0.001 # brushes closer than that are touching, not intersecting
 
 # + start tile
 # + random
 # + limit gen (cap all remaining connectors)
 # + check collisions for every brush
-# todo check tiles on load:
-# - for correct connector rotation
-# - for 1 brush (what about ducts?)
+# + check tiles on load (see `preflight_tile()`):
+# + for correct connector rotation
+# + for 1 brush (what about ducts?)
 
 # TODO / IDEAS:
 # -- set boundary_limit dynamically by checking cap tiles dimensions
@@ -30,22 +48,15 @@ OVERRIDE_SEED = 0#436750099
 # 1. Load tilesets
 # 2. Divide group-maps into smaller tilesets
 #   - make sure to autoname them (based on entrances)
-# 3. Test tiles
+# + 3. Test tiles
 #   - self-intersection
 # 4. Generate
 
 
 def center(ent):
     """Calculates center of a brush-entity"""
-    xs = []
-    ys = []
-    zs = []
-    for face in ent.brushes[0].faces:
-        x, y, z = list(zip(*face.points))
-        xs.extend(x)
-        ys.extend(y)
-        zs.extend(z)
-    return (min(xs) + max(xs)) / 2, (min(ys) + max(ys)) / 2, (min(zs) + max(zs)) / 2
+    x, y, z = ent.brushes[0].min_max()
+    return (x[0] + x[1]) / 2, (y[0] + y[1]) / 2, (z[0] + z[1]) / 2
 
 
 def min_max(brush):
@@ -56,15 +67,7 @@ def min_max(brush):
             (min z, max z),
         )
     """
-    xs = []
-    ys = []
-    zs = []
-    for face in brush.faces:
-        x, y, z = list(zip(*face.points))
-        xs.extend(x)
-        ys.extend(y)
-        zs.extend(z)
-    return (min(xs), max(xs)), (min(ys), max(ys)), (min(zs), max(zs))
+    return brush.min_max()
 
 
 def get_connectors(tile, con_type=None):
@@ -78,6 +81,29 @@ def get_connectors(tile, con_type=None):
     return connectors
 
 
+def mate_connectors(root):
+    """Removes pairs of root connectors which are at the same spot and facing each other,
+    it happens when placed tile closes a loop. Returns number of removed pairs
+    """
+    index = root.connector_index
+    connectors_to_remove = set()
+    closed_loops = 0
+
+    for con in index:
+        if con in connectors_to_remove:
+            continue
+
+        (x, y, z), angle = index.position(con)
+        for other_con in index.at(((x, y, z), (angle + 180) % 360)):
+            if other_con not in connectors_to_remove:
+                connectors_to_remove.add(con)
+                connectors_to_remove.add(other_con)
+                closed_loops += 1
+
+    root.remove_entities(connectors_to_remove)
+    return closed_loops
+
+
 def get_angle(connector_ent):
     return int(connector_ent.params["angles"].split()[1])
 
@@ -97,6 +123,361 @@ def gather_brushes(map_, ignore_connector=True):
     return brushes
 
 
+class BrushGrid:
+    """Uniform grid over XY plane with bounding boxes of brushes.
+
+    Each brush is stored in every cell its bounding box touches, so to find brushes
+    that might intersect with a box we only need to look into cells of that box.
+    """
+    CELL_SIZE = 256
+
+    def __init__(self):
+        self.cells = defaultdict(list)
+
+    def _cells(self, bbox):
+        (min_x, max_x), (min_y, max_y), _ = bbox
+        for x in range(int(min_x // self.CELL_SIZE), int(max_x // self.CELL_SIZE) + 1):
+            for y in range(int(min_y // self.CELL_SIZE), int(max_y // self.CELL_SIZE) + 1):
+                yield x, y
+
+    def add(self, brush, bbox=None):
+        """Adds `brush`, anything else can be added if its `bbox` is given"""
+        item = (brush, min_max(brush) if bbox is None else bbox)
+        for cell in self._cells(item[1]):
+            self.cells[cell].append(item)
+
+    def add_map(self, map_):
+        for brush in gather_brushes(map_):
+            self.add(brush)
+
+    def query(self, bbox):
+        """Yields (brush, bbox) of brushes which are close to `bbox`, each one once"""
+        seen = set()
+        for cell in self._cells(bbox):
+            for item in self.cells.get(cell, ()):
+                if id(item) not in seen:
+                    seen.add(id(item))
+                    yield item
+
+
+class ConnectorIndex:
+    """Open connectors of a map in the same order as they are in `map_.entities`.
+
+    Works as a read-only sequence (`len()`, `index[i]`, iteration), so `random.choice()` picks the same
+    connector as it would from a list of them. Connectors are kept in slots by their sequence number,
+    removed connector leaves empty slot, and a Fenwick tree of taken slots finds i-th connector, so
+    adding, removing and `index[i]` are O(log n). Connectors are also grouped by name and by position
+    (center and angle).
+    """
+    def __init__(self):
+        self._slots = list()  # connector or None, by sequence number
+        self._tree = list()   # Fenwick tree of taken slots, 1-based: `self._tree[k - 1]`
+        self._seq = dict()    # connector -> sequence number
+        self.by_name = defaultdict(dict)      # name -> {connector: None}
+        self.by_position = defaultdict(dict)  # (center, angle) -> {connector: None}
+
+    @staticmethod
+    def position(ent):
+        """Hashable (center, angle), center is rounded so tiny float errors don't matter"""
+        return tuple(round(v, CONNECTOR_PRECISION) for v in center(ent)), get_angle(ent) % 360
+
+    def _append_slot(self, ent):
+        # new node k covers slots (k - lowbit(k), k], sum of the ones before k is taken from existing nodes
+        k = len(self._slots) + 1
+        count = 1 if ent is not None else 0
+        j = k - 1
+        while j > k - (k & -k):
+            count += self._tree[j - 1]
+            j -= j & -j
+        self._slots.append(ent)
+        self._tree.append(count)
+
+    def _update(self, k, delta):
+        while k <= len(self._tree):
+            self._tree[k - 1] += delta
+            k += k & -k
+
+    def add(self, ent, seq=None):
+        """Adds connector to the end, or back to its place if `seq` returned by `remove()` is given"""
+        if seq is None:
+            seq = len(self._slots)
+        while len(self._slots) < seq:
+            self._append_slot(None)
+        if seq == len(self._slots):
+            self._append_slot(ent)
+        else:
+            assert self._slots[seq] is None, 'slot of the connector is taken'
+            self._slots[seq] = ent
+            self._update(seq + 1, 1)
+        self._seq[ent] = seq
+        self.by_name[ent.params["name"]][ent] = None
+        self.by_position[self.position(ent)][ent] = None
+
+    def remove(self, ent):
+        """Removes connector, returns its sequence number"""
+        seq = self._seq.pop(ent)
+        self._slots[seq] = None
+        self._update(seq + 1, -1)
+        # empty slots at the end are dropped, so undone merges don't leave them behind
+        while self._slots and self._slots[-1] is None:
+            self._slots.pop()
+            self._tree.pop()
+        self._discard(self.by_name, ent.params["name"], ent)
+        self._discard(self.by_position, self.position(ent), ent)
+        return seq
+
+    @staticmethod
+    def _discard(groups, key, ent):
+        group = groups[key]
+        del group[ent]
+        if not group:
+            del groups[key]
+
+    def get(self, name):
+        return list(self.by_name.get(name, ()))
+
+    def at(self, position):
+        return list(self.by_position.get(position, ()))
+
+    def __getitem__(self, i):
+        if not 0 <= i < len(self._seq):
+            raise IndexError('connector index out of range')
+        # descend the tree: the largest k with less than i + 1 taken slots up to it, connector is in slot k + 1
+        k = 0
+        step = 1 << (len(self._tree).bit_length() - 1)
+        while step > 0:
+            if k + step <= len(self._tree) and self._tree[k + step - 1] <= i:
+                k += step
+                i -= self._tree[k - 1]
+            step >>= 1
+        return self._slots[k]
+
+    def __iter__(self):
+        return (ent for ent in self._slots if ent is not None)
+
+    def __contains__(self, ent):
+        return ent in self._seq
+
+    def __len__(self):
+        return len(self._seq)
+
+
+class EntityNameIndex:
+    """Entities of a map by `targetname` and by names they refer to (`target`, `killtarget`).
+
+    Also keeps counters with `$count$<name>` in "health" (see `apply_special_count()`)
+    """
+    REFERENCE_PARAMS = ("target", "killtarget")
+
+    def __init__(self):
+        self.by_targetname = defaultdict(dict) # name -> {entity: None}
+        self.references = defaultdict(dict)    # name -> {entity that refers to it: None}
+        self.counters = dict()                 # counter entity -> name of counted entities
+
+    def _names(self, ent):
+        targetname = ent.params.get("targetname", "")
+        references = [ent.params[param] for param in self.REFERENCE_PARAMS if ent.params.get(param, "") != ""]
+        return targetname, references
+
+    def add(self, ent):
+        targetname, references = self._names(ent)
+        if targetname != "":
+            self.by_targetname[targetname][ent] = None
+        for name in references:
+            self.references[name][ent] = None
+        health = ent.params.get("health")
+        if isinstance(health, str) and health.startswith("$count$"):
+            self.counters[ent] = health[7:]
+
+    def remove(self, ent):
+        targetname, references = self._names(ent)
+        if targetname != "":
+            ConnectorIndex._discard(self.by_targetname, targetname, ent)
+        for name in references:
+            self.references[name].pop(ent, None)
+            if not self.references[name]:
+                del self.references[name]
+        self.counters.pop(ent, None)
+
+    def count(self, name):
+        """Number of entities with `targetname` equal to `name`"""
+        return len(self.by_targetname.get(name, ()))
+
+    def dangling(self):
+        """Names that entities refer to, but no entity has"""
+        return sorted(name for name in self.references if name not in self.by_targetname)
+
+
+class PlacedTile:
+    """Tile merged into the root: bounding box of the whole tile and grid of its brushes"""
+    def __init__(self, map_):
+        self.brush_grid = BrushGrid()
+        self.brush_grid.add_map(map_)
+        self.bbox = union_bbox(min_max(brush) for brush in gather_brushes(map_))
+
+
+class RootMap(p.Map):
+    """Map that is being generated, keeps indexes of brushes and connectors of every tile merged into it.
+
+    Merges only append to the map. Removed entities are replaced with None (tombstones) in private
+    `self._entities`, so indexes of other entities don't shift, tombstones are dropped by `compact()`.
+    `self.entities` never contains tombstones: it's a copy without them, so helpers made for
+    `p.Map` (`get_connectors()`, `gather_brushes()`, `transform()`) work on the root map too, but
+    entities must be added and removed only with `merge()` and `remove_entities()`.
+    Every merge and removal is written to undo log, so they can be reverted (see `mark()` and `undo()`)
+    """
+    def __init__(self, entities):
+        super().__init__(entities)
+        self.placed_tiles = [PlacedTile(self)]
+        self.connector_index = ConnectorIndex()
+        self._add_connectors(self._entities)
+        self.name_index = EntityNameIndex()
+        for ent in self._entities:
+            self.name_index.add(ent)
+        self._entity_idx = {ent: i for i, ent in enumerate(self._entities)}
+        self._removed_count = 0
+        self._undo_log = []
+
+    @property
+    def entities(self):
+        return [ent for ent in self._entities if ent is not None]
+
+    @entities.setter
+    def entities(self, entities):
+        # only `p.Map.__init__()` sets entities, indexes would be stale after any later change
+        assert not hasattr(self, "_entities"), 'entities of root map are changed only by merge() and remove_entities()'
+        self._entities = entities
+
+    def _add_connectors(self, entities):
+        for ent in entities:
+            if ent.params["classname"] == "info_connector":
+                self.connector_index.add(ent)
+
+    def merge(self, other_map):
+        entities_count = len(self._entities)
+        self._undo_log.append(("merge", len(self.worldspawn.brushes), entities_count))
+        # `p.Map.merge()` would extend the copy returned by `self.entities`, so entities are appended here
+        if other_map.worldspawn is not None and other_map.worldspawn.brushes is not None:
+            self.worldspawn.brushes.extend(other_map.worldspawn.brushes)
+        self._entities.extend(other_map.entities)
+        for i, ent in enumerate(other_map.entities, entities_count):
+            self._entity_idx[ent] = i
+            self.name_index.add(ent)
+        self.placed_tiles.append(PlacedTile(other_map))
+        self._add_connectors(other_map.entities)
+        return self
+
+    def remove_entities(self, entities):
+        removed = []
+        for ent in dict.fromkeys(entities):
+            idx = self._entity_idx.pop(ent)
+            self.name_index.remove(ent)
+            seq = self.connector_index.remove(ent) if ent in self.connector_index else None
+            self._entities[idx] = None
+            removed.append((idx, ent, seq))
+        self._removed_count += len(removed)
+        self._undo_log.append(("remove", removed))
+
+    def compact(self):
+        """Drops tombstones of removed entities. Indexes of entities change, so undo log is cleared"""
+        if self._removed_count > 0:
+            self._entities = self.entities
+            self._entity_idx = {ent: i for i, ent in enumerate(self._entities)}
+            self._removed_count = 0
+        self._undo_log.clear()
+
+    def mark(self):
+        """Current position in undo log"""
+        return len(self._undo_log)
+
+    def undo(self, mark):
+        """Reverts merges and removals made after `mark()` was taken"""
+        assert mark <= len(self._undo_log), 'undo log was cleared by compact() after the mark was taken'
+        while len(self._undo_log) > mark:
+            record = self._undo_log.pop()
+            if record[0] == "merge":
+                _, brushes_count, entities_count = record
+                # merged brushes and entities are at the end, everything after them is already reverted
+                del self.worldspawn.brushes[brushes_count:]
+                for ent in self._entities[entities_count:]:
+                    del self._entity_idx[ent]
+                    self.name_index.remove(ent)
+                    if ent in self.connector_index:
+                        self.connector_index.remove(ent)
+                del self._entities[entities_count:]
+                self.placed_tiles.pop()
+            else:
+                _, removed = record
+                for idx, ent, seq in removed:
+                    self._entities[idx] = ent
+                    self._entity_idx[ent] = idx
+                    self.name_index.add(ent)
+                    if seq is not None:
+                        self.connector_index.add(ent, seq)
+                self._removed_count -= len(removed)
+
+
+class Placement:
+    """Tile that is rotated and moved, but only "on paper".
+
+    Tile itself is used as immutable prototype, bounding boxes and centers are transformed on the fly
+    and geometry is copied only when placement is accepted (see `materialize()`)
+    """
+    def __init__(self, tile, tile_bbox=None):
+        self.tile = tile
+        self.deg = None
+        self.vec = None
+        self._tile_bbox = tile_bbox # bounding box of the placed tile, when it's already known
+
+    def rotate(self, deg):
+        assert self.deg is None and self.vec is None, 'only one rotation followed by one move is supported'
+        self.deg = deg
+        return self
+
+    def move(self, vec):
+        assert self.vec is None, 'only one rotation followed by one move is supported'
+        self.vec = vec
+        return self
+
+    def bbox(self, brush):
+        """Bounding box of tile's `brush` after transformation"""
+        return p.transform_bbox(min_max(brush), self.deg, self.vec)
+
+    def tile_bbox(self):
+        """Bounding box of the whole tile after transformation"""
+        if self._tile_bbox is None:
+            self._tile_bbox = union_bbox(self.bbox(brush) for brush in gather_brushes(self.tile))
+        return self._tile_bbox
+
+    def hull(self, brush):
+        """Convex hull (see `brush_hull()`) of tile's `brush` after transformation, None for broken brush"""
+        hull = brush_hull(brush)
+        if hull is None:
+            return None
+        if hull.is_box:
+            return box_hull(self.bbox(brush))
+        deg = self.deg or 0
+        dx, dy, dz = self.vec or (0, 0, 0)
+        return Hull(
+            [(x + dx, y + dy, z + dz) for x, y, z in (p.rotate(v, deg) for v in hull.vertices)],
+            [tuple(p.rotate(n, deg)) for n in hull.normals],
+            [tuple(p.rotate(e, deg)) for e in hull.edges],
+            False,
+        )
+
+    def center(self, ent):
+        """Center of tile's brush-entity after transformation"""
+        x, y, z = self.bbox(ent.brushes[0])
+        return (x[0] + x[1]) / 2, (y[0] + y[1]) / 2, (z[0] + z[1]) / 2
+
+    def materialize(self):
+        """Returns transformed copy of the tile"""
+        with instrument.timer("deepcopy"):
+            tile = copy.deepcopy(self.tile)
+        with instrument.timer("transform"):
+            return tile.transform(self.deg, self.vec)
+
+
 def is_brush_intersect(brush_a, brush_b, expand=0):
     if isinstance(brush_a, p.Brush):
         a = min_max(brush_a)
@@ -137,44 +518,261 @@ def is_entity_inside_brush(ent, brush):
     return intersected_axis
 
 
-def is_tile_intersect(root, tmp_tile):
-    root_brushes = gather_brushes(root)
-    tile_brushes = gather_brushes(tmp_tile)
+def is_bbox_overlap(a, b):
+    return (a[0][0] < b[0][1] and a[0][1] > b[0][0]
+            and a[1][0] < b[1][1] and a[1][1] > b[1][0]
+            and a[2][0] < b[2][1] and a[2][1] > b[2][0])
 
-    for brush_a in root_brushes:
-        for brush_b in tile_brushes:
-            axis = is_brush_intersect(brush_a, brush_b)
 
-            if all(axis):
-                print(brush_a)
-                print(brush_b)
-                if str(brush_a) == str(brush_b):
-                    print("error: brushes are identical")
-                #print("intersection")
-                return True
-            # else:
-            #     print("Ok")
-    return False
+def _sub(a, b):
+    return a[0] - b[0], a[1] - b[1], a[2] - b[2]
 
 
-def is_outside_world_boundry(tmp_tile):
-    for brush in tmp_tile.worldspawn.brushes:
-        a = min_max(brush)
-        for i in range(3):
-            for j in range(2):
-                if a[i][j] > BOUNDARY_LIMIT or a[i][j] < -BOUNDARY_LIMIT:
+def _dot(a, b):
+    return a[0] * b[0] + a[1] * b[1] + a[2] * b[2]
+
+
+def _cross(a, b):
+    return a[1] * b[2] - a[2] * b[1], a[2] * b[0] - a[0] * b[2], a[0] * b[1] - a[1] * b[0]
+
+
+def _normalize(v):
+    """Unit vector, None for (almost) zero vector"""
+    length = _dot(v, v) ** 0.5
+    if length < 1e-9:
+        return None
+    return v[0] / length, v[1] / length, v[2] / length
+
+
+def _directions(vectors):
+    """Unique unit directions of `vectors`, opposite vectors are the same direction"""
+    directions = {}
+    for v in vectors:
+        v = _normalize(v)
+        if v is None:
+            continue
+        # the same sign for v and -v
+        if next(c for c in v if abs(c) > 1e-9) < 0:
+            v = (-v[0], -v[1], -v[2])
+        directions.setdefault(tuple(round(c, 6) for c in v), v)
+    return list(directions.values())
+
+
+Hull = namedtuple("Hull", "vertices normals edges is_box") # is_box - brush is the same as its bounding box
+AXES = {(1.0, 0.0, 0.0), (0.0, 1.0, 0.0), (0.0, 0.0, 1.0)}
+
+
+def _oriented(planes, inside):
+    """Flips planes, so `inside` point is behind all of them"""
+    return [(n, d) if _dot(n, inside) <= d else ((-n[0], -n[1], -n[2]), -d) for n, d in planes]
+
+
+def _hull_vertices(planes):
+    """Points where 3 planes meet, which are not in front of any plane"""
+    vertices = []
+    for (n1, d1), (n2, d2), (n3, d3) in combinations(planes, 3):
+        n2n3, n3n1, n1n2 = _cross(n2, n3), _cross(n3, n1), _cross(n1, n2)
+        det = _dot(n1, n2n3)
+        if abs(det) < 1e-9:
+            continue
+        v = tuple((d1 * a + d2 * b + d3 * c) / det for a, b, c in zip(n2n3, n3n1, n1n2))
+        if all(_dot(n, v) <= d + HULL_EPSILON for n, d in planes):
+            if all(abs(v[0] - u[0]) + abs(v[1] - u[1]) + abs(v[2] - u[2]) > HULL_EPSILON for u in vertices):
+                vertices.append(v)
+    return vertices
+
+
+def box_hull(bbox):
+    """Hull of axis aligned box"""
+    (min_x, max_x), (min_y, max_y), (min_z, max_z) = bbox
+    vertices = [(x, y, z) for x in (min_x, max_x) for y in (min_y, max_y) for z in (min_z, max_z)]
+    axes = sorted(AXES)
+    return Hull(vertices, axes, axes, True)
+
+
+def convex_hull(faces):
+    """Vertices, face normals and edge directions of convex brush from 3 points of every face plane
+    (see `Brush.plane_points()`). Returns None if planes don't enclose any volume
+    """
+    planes = []
+    for p1, p2, p3 in faces:
+        # points of a face go clockwise, so normal points out of the brush
+        normal = _normalize(_cross(_sub(p1, p2), _sub(p3, p2)))
+        if normal is not None:
+            planes.append((normal, _dot(normal, p1)))
+
+    vertices = _hull_vertices(planes)
+    if len(vertices) < 4:
+        # points of some faces go the other way, face points are usually vertices of the brush,
+        # so their centroid is inside of it
+        points = [point for face in faces for point in face]
+        vertices = _hull_vertices(_oriented(planes, tuple(sum(c) / len(points) for c in zip(*points))))
+        if len(vertices) < 4:
+            return None
+
+    planes = _oriented(planes, tuple(sum(c) / len(vertices) for c in zip(*vertices)))
+
+    # edge is a line where 2 faces share at least 2 vertices
+    edges = []
+    for (n1, d1), (n2, d2) in combinations(planes, 2):
+        shared = [v for v in vertices if abs(_dot(n1, v) - d1) <= HULL_EPSILON and abs(_dot(n2, v) - d2) <= HULL_EPSILON]
+        if len(shared) >= 2:
+            edges.append(_cross(n1, n2))
+
+    normals = _directions(n for n, _ in planes)
+    return Hull(vertices, normals, _directions(edges), all(n in AXES for n in normals))
+
+
+_hulls = {}
+
+
+def brush_hull(brush):
+    """`convex_hull()` of the brush, hulls are cached by content of the brush"""
+    key = brush_key(brush)
+    if key not in _hulls:
+        if len(_hulls) >= 100_000:
+            _hulls.clear()
+        _hulls[key] = convex_hull(brush.plane_points())
+    return _hulls[key]
+
+
+def is_hull_intersect(a, b):
+    """Separating axis test of two convex hulls, touching hulls don't intersect.
+
+    Hulls are separated if their projections don't overlap on any face normal
+    or on cross product of any pair of their edges
+    """
+    vertices_a, normals_a, edges_a, _ = a
+    vertices_b, normals_b, edges_b, _ = b
+    edge_axes = (_normalize(_cross(ea, eb)) for ea in edges_a for eb in edges_b)
+
+    for axis in chain(normals_a, normals_b, edge_axes):
+        if axis is None:
+            continue # parallel edges
+        projection_a = [_dot(axis, v) for v in vertices_a]
+        projection_b = [_dot(axis, v) for v in vertices_b]
+        if (max(projection_a) <= min(projection_b) + HULL_EPSILON
+                or max(projection_b) <= min(projection_a) + HULL_EPSILON):
+            return False
+    return True
+
+
+def is_tile_intersect(root, placement):
+    """Checks if placed tile collides with anything in the root.
+
+    Broad phase compares bounding box of the whole tile with already placed tiles,
+    brushes are compared only for tiles that overlap. Brushes with overlapping bounding
+    boxes are then checked by their actual shapes (see `EXACT_COLLISION`)
+    """
+    tile_bbox = placement.tile_bbox()
+    if tile_bbox is None:
+        return False
+
+    placed_tiles = [placed for placed in root.placed_tiles
+                    if placed.bbox is not None and is_bbox_overlap(placed.bbox, tile_bbox)]
+    if len(placed_tiles) == 0:
+        return False
+
+    for brush_b in gather_brushes(placement.tile):
+        bbox_b = placement.bbox(brush_b)
+        hull_b = None
+
+        for placed in placed_tiles:
+            if not is_bbox_overlap(placed.bbox, bbox_b):
+                continue
+
+            for brush_a, bbox_a in placed.brush_grid.query(bbox_b):
+                if is_bbox_overlap(bbox_a, bbox_b):
+                    if EXACT_COLLISION:
+                        if hull_b is None:
+                            hull_b = placement.hull(brush_b) or False
+                        hull_a = brush_hull(brush_a)
+                        # bounding boxes of boxes are exact
+                        if (hull_a and hull_b and not (hull_a.is_box and hull_b.is_box)
+                                and not is_hull_intersect(hull_a, hull_b)):
+                            instrument.count("exact collision passed")
+                            continue
+                    log.debug("intersection with brush %s, bbox %s", brush_a, bbox_b)
+                    if bbox_a == bbox_b:
+                        log.debug("brushes are identical")
                     return True
     return False
 
 
-def load_tileset(tileset_dir: Path):
-    print("loading tileset:", tileset_dir)
+def is_outside_world_boundry(bbox):
+    if bbox is None:
+        return False
+    for i in range(3):
+        for j in range(2):
+            if bbox[i][j] > BOUNDARY_LIMIT or bbox[i][j] < -BOUNDARY_LIMIT:
+                return True
+    return False
 
-    start_tiles = list()
-    cap_tiles = list()
-    tiles = list()
 
-    for basename in os.listdir(tileset_dir):
+def union_bbox(bboxes):
+    """Bounding box of all `bboxes`, None if there are none"""
+    bboxes = list(bboxes)
+    if len(bboxes) == 0:
+        return None
+    return tuple(
+        (min(b[i][0] for b in bboxes), max(b[i][1] for b in bboxes))
+        for i in range(3)
+    )
+
+
+TilePlacement = namedtuple("TilePlacement", "tile tile_name connector_idx deg offset bbox worldspawn_bbox")
+
+
+class TileCatalog:
+    """Every way to attach tiles to a connector, precomputed once at load time.
+
+    For every connector of every tile and every rotation it keeps the connector position
+    and bounding boxes of the rotated tile. Placements are indexed by connector name and
+    angle of the root connector they fit to, so candidates are enumerated without
+    copying or transforming tiles.
+
+    `tiles` are (tile, tile name, TileInfo), everything is computed from TileInfo (see `preflight_tile()`)
+    """
+    ROTATIONS = (0, 90, 180, 270)
+
+    def __init__(self, tiles):
+        # (name, root connector angle) -> [[placements of tile 1], [placements of tile 2], ...]
+        self.placements = defaultdict(list)
+        self.names = set()
+
+        for tile, tile_name, info in tiles:
+            by_key = defaultdict(list)
+            for deg in self.ROTATIONS:
+                bbox = p.transform_bbox(info.bbox, deg) if info.bbox else None
+                worldspawn_bbox = p.transform_bbox(info.worldspawn_bbox, deg) if info.worldspawn_bbox else None
+
+                for connector in info.connectors:
+                    offset = tuple(p.rotate(connector.center, deg))
+                    # root connector has to face the opposite way, see `Placement`
+                    angle_a = (180 + connector.angle - deg) % 360
+                    by_key[connector.name, angle_a].append(
+                        TilePlacement(tile, tile_name, connector.idx, deg, offset, bbox, worldspawn_bbox))
+
+            for key, placements in by_key.items():
+                self.placements[key].append(placements)
+                self.names.add(key[0])
+
+    def candidates(self, connector):
+        """Placements that fit to root `connector` in random order.
+
+        Tiles are shuffled first and then connectors of each tile, so every tile
+        is equally likely to be tried first regardless of number of its connectors
+        """
+        tiles = self.placements.get((connector.params["name"], get_angle(connector) % 360), [])
+        for placements in random.sample(tiles, len(tiles)):
+            yield from random.sample(placements, len(placements))
+
+
+def tileset_paths(tileset_dir: Path):
+    """Sorted list of tiles in tileset directory, sorting keeps seeds reproducible"""
+    paths = list()
+
+    for basename in sorted(os.listdir(tileset_dir)):
         path = tileset_dir / basename
         if not os.path.isfile(path):
             continue
@@ -187,30 +785,50 @@ def load_tileset(tileset_dir: Path):
         if not basename.endswith(".map"):
             continue
 
-        print("  ", basename)
+        paths.append(path)
+
+    return paths
+
+
+def divide_tileset(paths, maps):
+    start_tiles = list()
+    cap_tiles = list()
+    tiles = list()
+
+    for path, map_ in zip(paths, maps):
+        basename = path.name
+        log.debug("   %s", basename)
 
         if basename == "start.map" or basename.startswith("start_"):
-            start_tiles.append((p.parse_map(open(path)), basename))
+            start_tiles.append((map_, basename))
             continue
 
         if basename == "cap.map" or basename.startswith("cap_"):
-            cap_tiles.append((p.parse_map(open(path)), basename))
+            cap_tiles.append((map_, basename))
             continue
 
-        tiles.append((p.parse_map(open(path)), basename))
+        tiles.append((map_, basename))
 
     return start_tiles, cap_tiles, tiles
 
 
-def load_tiles(root_dir: Path):
-    tilesets = dict()
+def load_tileset(tileset_dir: Path, executor=None):
+    """Loads tiles of a tileset, if `executor` is given - tiles are parsed by it"""
+    log.info("loading tileset: %s", tileset_dir)
+
+    paths = tileset_paths(tileset_dir)
+    maps = (executor.map if executor is not None else map)(tile_cache.parse_map, paths)
+
+    return divide_tileset(paths, maps)
 
-    for basename in os.listdir(root_dir):
-        path = root_dir / basename
-        if os.path.isdir(path):
-            tilesets[basename] = load_tileset(path)
 
-    return tilesets
+def load_tiles(root_dir: Path, workers=None):
+    """Loads all tilesets in `root_dir`, tiles are parsed in parallel by `workers` processes"""
+    tileset_dirs = [root_dir / basename for basename in sorted(os.listdir(root_dir)) if os.path.isdir(root_dir / basename)]
+
+    with ProcessPoolExecutor(workers) as executor:
+        # tilesets are loaded one by one, but each of them has enough tiles to keep every worker busy
+        return {tileset_dir.name: load_tileset(tileset_dir, executor) for tileset_dir in tileset_dirs}
 
 
 def rename_entities(tile, prefix: int):
@@ -228,37 +846,32 @@ def rename_entities(tile, prefix: int):
         "targetname",
         "killtarget",
     ]
+    prefix = f"tile{prefix:03}_"
     for ent in tile.entities:
+        params = ent.params
         for name in param_names:
-            if name in ent.params and ent.params[name] != "":
-                if ent.params[name].startswith("g_"):
-                    continue
-                elif ent.params[name].startswith("$count$"):
-                    continue # see `apply_special_count()`
-                elif (ent.params["classname"] == "game_player_equip"
-                and ent.params[name] == "game_playerspawn"):
-                    continue
-                else:
-                    ent.params[name] = f"tile{prefix:03}_{ent.params[name]}"
+            value = params.get(name, "")
+            if value == "":
+                continue
+            if value.startswith("g_"):
+                continue
+            elif value.startswith("$count$"):
+                continue # see `apply_special_count()`
+            elif params["classname"] == "game_player_equip" and value == "game_playerspawn":
+                continue
+            else:
+                params[name] = prefix + value
 
 
 def apply_special_count(root):
-    counters_to_replace = []
-    counter = defaultdict(int)
+    """Replaces `$count$<name>` with number of entities named <name>, counted by `root.name_index`"""
     # TODO: currently works only with "Limit value" (health) of game_counter
-    for i, ent in enumerate(root.entities):
-        if "health" in ent.params and ent.params["health"].startswith("$count$"):
-            counters_to_replace.append((i, ent.params["health"][7:]))
-
-    for i, ent in enumerate(root.entities):
-        for _, name in counters_to_replace:
-            if "targetname" in ent.params and ent.params["targetname"] == name:
-                counter[name] += 1
-
-    print("Replace counters:")
-    for idx, name in counters_to_replace:
-        print(idx, name, counter[name])
-        root.entities[idx].params["health"] = counter[name]
+    index = root.name_index
+    log.debug("Replace counters:")
+    for ent, name in index.counters.items():
+        log.debug("%s %s", name, index.count(name))
+        ent.params["health"] = index.count(name)
+    index.counters.clear()
 
 
 def apply_entity_mapgen_choice(tile):
@@ -282,140 +895,333 @@ def apply_entity_mapgen_choice(tile):
     tile.entities = other_entities
 
 
+def is_xy_overlap(a, b, expand):
+    """Same as `is_brush_intersect(a, b, expand)` for bounding boxes, but checks only X and Y axis"""
+    return (a[0][0] - expand < b[0][1] + expand and a[0][1] + expand > b[0][0] - expand
+            and a[1][0] - expand < b[1][1] + expand and a[1][1] + expand > b[1][0] - expand)
+
+
+def expand_xy(bbox, expand):
+    (min_x, max_x), (min_y, max_y), z = bbox
+    return (min_x - expand, max_x + expand), (min_y - expand, max_y + expand), z
+
+
 def slice_map_into_tiles(map_):
-    """Given map with multiple tiles, this function finds brush and enity groups and returns list of these groups (tiles)"""
-    empty = p.parse_map(open("tiles/empty.map"))
+    """Given map with multiple tiles, this function finds brush and enity groups and returns list of these groups (tiles)
 
+    Brushes closer than 2*31 units start a group, then groups with bounding boxes closer
+    than 2*28 units are merged until no such groups are left. Brushes and groups are
+    looked up in grids, the merge order (and so the order of brushes in a tile) is the same
+    as when every group is compared with every other group.
+    """
+    empty = tile_cache.parse_map("tiles/empty.map")
+    brushes = map_.worldspawn.brushes
+
+    brush_grid = BrushGrid()
+    brush_indexes = {}
+    for brush_idx, brush in enumerate(brushes):
+        brush_grid.add(brush)
+        brush_indexes[id(brush)] = brush_idx
+
+    # Every brush that is not in a group yet, starts a group with brushes that touch it.
+    # Group is a list of maps, they are merged into one tile at the end
     groups = {}
-    worldspawn_indexes = []
-    entity_indexes = []
+    group_bboxes = {}
+    is_grouped = [False] * len(brushes)
 
-    for brush_idx, brush in enumerate(map_.worldspawn.brushes):
-        if brush_idx in worldspawn_indexes:
+    for brush_idx, brush in enumerate(brushes):
+        if is_grouped[brush_idx]:
             continue
 
-        groups[brush_idx] = copy.deepcopy(empty)
-        groups[brush_idx].worldspawn.brushes.append(brush)
-        worldspawn_indexes.append(brush_idx)
-
-        for other_brush_idx, other_brush in enumerate(map_.worldspawn.brushes[brush_idx + 1:]):
-            other_brush_idx += brush_idx + 1
-            if other_brush_idx in worldspawn_indexes:
-                continue
+        bbox = min_max(brush)
+        near_indexes = sorted(
+            brush_indexes[id(other_brush)]
+            for other_brush, other_bbox in brush_grid.query(expand_xy(bbox, 2 * 31))
+            if brush_indexes[id(other_brush)] > brush_idx
+               and not is_grouped[brush_indexes[id(other_brush)]]
+               and is_xy_overlap(bbox, other_bbox, expand=31)
+        )
 
-            axis = is_brush_intersect(brush, other_brush, expand=31)
+        group = copy.deepcopy(empty)
+        group.worldspawn.brushes.append(brush)
+        is_grouped[brush_idx] = True
+        for other_brush_idx in near_indexes:
+            group.worldspawn.brushes.append(brushes[other_brush_idx])
+            is_grouped[other_brush_idx] = True
+
+        groups[brush_idx] = [group]
+        group_bboxes[brush_idx] = union_bbox(min_max(b) for b in group.worldspawn.brushes)
+
+    # Grid of group indexes, grown groups are added to new cells and merged groups are removed
+    group_grid = defaultdict(set)
+
+    def add_to_grid(gidx):
+        for cell in brush_grid._cells(group_bboxes[gidx]):
+            group_grid[cell].add(gidx)
+
+    def remove_from_grid(gidx):
+        for cell in brush_grid._cells(group_bboxes[gidx]):
+            group_grid[cell].discard(gidx)
+
+    def touching_groups(gidx, bbox, expand):
+        """Sorted indexes of groups which are closer than `2*expand` to `bbox`"""
+        found = set()
+        for cell in brush_grid._cells(expand_xy(bbox, 2 * expand)):
+            found.update(group_grid.get(cell, ()))
+        return sorted(i for i in found if i != gidx and is_xy_overlap(bbox, group_bboxes[i], expand))
+
+    for gidx in groups:
+        add_to_grid(gidx)
+
+    # Groups are visited in order and first group that touches others takes all of them, then
+    # visiting starts over. Groups before `pos` don't touch anything, so instead of starting over
+    # we go back only when one of them touches the grown group.
+    group_indexes = list(groups)
+    pos = 0
+    while pos < len(group_indexes):
+        gidx1 = group_indexes[pos]
+        if gidx1 not in groups:
+            pos += 1
+            continue
 
-            if axis[0] and axis[1]:
-                groups[brush_idx].worldspawn.brushes.append(other_brush)
-                worldspawn_indexes.append(other_brush_idx)
+        merged_indexes = touching_groups(gidx1, group_bboxes[gidx1], expand=28)
+        if len(merged_indexes) == 0:
+            pos += 1
+            continue
 
-    # Look for leftover brushes
-    if len(worldspawn_indexes) < len(map_.worldspawn.brushes):
-        print(f"error: there is leftover brushes ({len(worldspawn_indexes) - len(map_.worldspawn.brushes)})")
+        remove_from_grid(gidx1)
+        for gidx2 in merged_indexes:
+            remove_from_grid(gidx2)
+            groups[gidx1] += groups.pop(gidx2)
+            log.debug("merge %s %s", gidx1, gidx2)
 
-    def calculate_bbox(map_):
-        bbox = None
-        for brush in map_.worldspawn.brushes:
-            x, y, z = min_max(brush)
-            if bbox is None:
-                bbox = (x,y,z)
+        group_bboxes[gidx1] = union_bbox([group_bboxes[gidx1], *(group_bboxes.pop(i) for i in merged_indexes)])
+        add_to_grid(gidx1)
 
-            x1,y1,z1 = bbox
-            x = (min(x[0], x1[0]), max(x[1], x1[1]))
-            y = (min(y[0], y1[0]), max(y[1], y1[1]))
-            z = (min(z[0], z1[0]), max(z[1], z1[1]))
-            bbox = (x,y,z)
-        return bbox
+        touching = touching_groups(gidx1, group_bboxes[gidx1], expand=28)
+        if len(touching) > 0 and touching[0] < gidx1:
+            pos = bisect_left(group_indexes, touching[0])
 
-    while True:
-        for gidx1, g1 in groups.items():
-            bbox1 = calculate_bbox(g1)
-            merged_indexes = []
-            for gidx2, g2 in groups.items():
-                if gidx1 == gidx2:
-                    continue
-
-                bbox2 = calculate_bbox(g2)
-                axis = is_brush_intersect(bbox1, bbox2, expand=28)
-                if axis[0] and axis[1]:
-                    groups[gidx1].merge(groups[gidx2])
-                    merged_indexes.append(gidx2)
-                    print(f"merge {gidx1} {gidx2}")
-
-            for idx in merged_indexes:
-                del groups[idx]
-
-            if len(merged_indexes) > 0:
-                break
-        else:
-            break
+    # Entity goes to the first group it touches
+    group_entities = defaultdict(list)
+    entities_left = 0
 
-    # Get bboxes
-    group_bboxes = {}
-    for i, g in groups.items():
-        group_bboxes[i] = calculate_bbox(g)
+    for ent in map_.entities:
+        if ent.params["classname"] == "info_tile":
+            if len(groups) == 0:
+                entities_left += 1
+            continue
 
-    for gidx, bbox in group_bboxes.items():
-        for ent_idx, ent in enumerate(map_.entities):
-            if ent_idx in entity_indexes:
-                    continue
+        if len(ent.brushes) > 0:
+            candidates = set()
+            for ent_brush in ent.brushes:
+                bbox = min_max(ent_brush)
+                candidates.update(touching_groups(None, bbox, expand=31))
+        else:
+            x, y, _ = [float(x) for x in ent.params["origin"].split()]
+            point = ((x, x), (y, y), (0, 0))
+            candidates = [i for i in touching_groups(None, point, expand=0)
+                          if all(is_entity_inside_brush(ent, group_bboxes[i])[:2])]
 
-            if ent.params["classname"] == "info_tile":
-                entity_indexes.append(ent_idx)
-                continue
+        if len(candidates) > 0:
+            group_entities[min(candidates)].append(ent)
+        else:
+            entities_left += 1
 
-            if len(ent.brushes) > 0:
-                for ent_brush in ent.brushes:
-                    axis = is_brush_intersect(ent_brush, bbox, expand=31)
-                    if axis[0] and axis[1]:
-                        break
-            else:
-                axis = is_entity_inside_brush(ent, bbox)
-            
-            if axis[0] and axis[1]:
-                groups[gidx].entities.append(ent)
-                entity_indexes.append(ent_idx)
+    # Look for leftover entities
+    if entities_left > 0:
+        log.error("there is leftover entities (%d)", -entities_left)
 
-    # Look for leftover brushes
-    if len(entity_indexes) < len(map_.entities):
-        print(f"error: there is leftover entities ({len(entity_indexes) - len(map_.entities)})")
+    tiles = []
+    for gidx, group in groups.items():
+        tile = group[0]
+        tile.worldspawn.brushes = list(chain.from_iterable(g.worldspawn.brushes for g in group))
+        tile.entities = list(chain(chain.from_iterable(g.entities for g in group), group_entities[gidx]))
+        tiles.append(tile)
 
-    print("total groups found:", len(groups))
+    log.info("total groups found: %d", len(tiles))
 
-    # for i, g in enumerate(groups.values()):
+    # for i, g in enumerate(tiles):
     #     name = f"debug_tile_{i:03}.map"
     #     g.write(name)
     #     print("saved", name)
     #     print("   brushes:", len(g.worldspawn.brushes))
     #     print("  entities:", len(g.entities))
 
-    return groups.values()
+    return tiles
 
 
-def check_tile_has_connector(tile):
+def brush_key(brush):
+    """Hashable content of a brush"""
+    if isinstance(brush, p.LazyBrush) and brush.lines is not None:
+        # don't decode brush just to compare it
+        return tuple(brush.lines)
+    return brush.data.tobytes(), brush.textures
+
+
+def entity_key(ent):
+    """Hashable content of an entity"""
+    return tuple(ent.params.items()), tuple(brush_key(brush) for brush in ent.brushes)
+
+
+def entity_bbox(ent):
+    """Bounding boxes of entity brushes or of its origin"""
+    if len(ent.brushes) > 0:
+        return [min_max(brush) for brush in ent.brushes]
+    x, y, z = [float(x) for x in ent.params["origin"].split()]
+    return [((x, x), (y, y), (z, z))]
+
+
+def tile_xy_bbox(tile):
+    """Bounding box of brushes and entities of a sliced tile, None if it's empty"""
+    bboxes = [min_max(brush) for brush in tile.worldspawn.brushes]
     for ent in tile.entities:
-        if ent.params.get("classname") == "info_connector":
-            return True
-    return False
+        if ent.params["classname"] != "info_tile":
+            bboxes += entity_bbox(ent)
+    return union_bbox(bboxes)
+
+
+def with_brush_indexes(map_, tiles):
+    """Pairs every tile with indexes of its brushes in `map_`"""
+    brush_order = {id(brush): i for i, brush in enumerate(map_.worldspawn.brushes)}
+    return [(tile, [brush_order[id(brush)] for brush in tile.worldspawn.brushes]) for tile in tiles]
+
+
+def is_same_order(a, b):
+    """Checks that items of `a` and `b` are ordered the same way"""
+    order = sorted(range(len(a)), key=a.__getitem__)
+    return all(b[i] < b[j] for i, j in zip(order, order[1:]))
+
+
+def reslice_map_into_tiles(map_, previous):
+    """Same as `slice_map_into_tiles(map_)`, but reuses tiles of `previous` slicing which didn't change.
+
+    `previous` and result are lists of tiles with indexes of their brushes (see `with_brush_indexes()`).
+    Tile is reused if its brushes and entities are still in the map in the same order and nothing
+    changed near it, only the rest of the map is sliced again. Groups sliced again can grow past
+    the changes, so tiles they reach are released and sliced again too (until nothing is reached)
+    """
+    brushes = map_.worldspawn.brushes
+    entities = map_.entities
+
+    brush_indexes = defaultdict(list)
+    for brush_idx, brush in reversed(list(enumerate(brushes))):
+        brush_indexes[brush_key(brush)].append(brush_idx)
+
+    entity_indexes = defaultdict(list)
+    for ent_idx, ent in reversed(list(enumerate(entities))):
+        entity_indexes[entity_key(ent)].append(ent_idx)
+
+    def release(indexes, keys, claimed):
+        for key, idx in zip(keys, claimed):
+            indexes[key].append(idx)
+
+    def claim(indexes, keys):
+        """Indexes of items with `keys`, None if some of them are missing"""
+        claimed = []
+        for key in keys:
+            if len(indexes[key]) == 0:
+                release(indexes, keys, claimed)
+                return None
+            claimed.append(indexes[key].pop())
+        return claimed
+
+    reused = {}
+    for tile_idx, (tile, previous_indexes) in enumerate(previous):
+        keys = [brush_key(brush) for brush in tile.worldspawn.brushes]
+        tile_brushes = claim(brush_indexes, keys)
+        if tile_brushes is None:
+            continue
+        ent_keys = [entity_key(ent) for ent in tile.entities]
+        tile_entities = claim(entity_indexes, ent_keys)
+        if tile_entities is None:
+            release(brush_indexes, keys, tile_brushes)
+            continue
+        # order of brushes affects the order they have in sliced tile
+        if not is_same_order(previous_indexes, tile_brushes) or tile_entities != sorted(tile_entities):
+            release(brush_indexes, keys, tile_brushes)
+            release(entity_indexes, ent_keys, tile_entities)
+            continue
+        reused[tile_idx] = (tile_brushes, tile_entities, tile_xy_bbox(tile))
+
+    changed_brushes = set(range(len(brushes)))
+    changed_entities = set(range(len(entities)))
+    for tile_brushes, tile_entities, _ in reused.values():
+        changed_brushes.difference_update(tile_brushes)
+        changed_entities.difference_update(tile_entities)
+
+    # Anything changed close to a tile could be merged with it, so the tile is sliced again
+    changed_grid = BrushGrid()
+
+    def add_changed(brush_idxs, ent_idxs):
+        for brush_idx in brush_idxs:
+            changed_grid.add(brushes[brush_idx])
+        for ent_idx in ent_idxs:
+            if entities[ent_idx].params["classname"] != "info_tile":
+                for bbox in entity_bbox(entities[ent_idx]):
+                    changed_grid.add(entities[ent_idx], bbox)
+
+    add_changed(changed_brushes, changed_entities)
+    is_changed = True
+    while is_changed:
+        is_changed = False
+        for tile_idx, (tile_brushes, tile_entities, bbox) in list(reused.items()):
+            if any(is_xy_overlap(bbox, other_bbox, expand=31)
+                   for _, other_bbox in changed_grid.query(expand_xy(bbox, 2 * 31))):
+                del reused[tile_idx]
+                changed_brushes.update(tile_brushes)
+                changed_entities.update(tile_entities)
+                add_changed(tile_brushes, tile_entities)
+                is_changed = True
+
+    sliced = []
+    while len(changed_brushes) > 0 or len(changed_entities) > 0:
+        worldspawn = p.Entity(map_.worldspawn.params, [brushes[i] for i in sorted(changed_brushes)])
+        changed_map = p.Map([worldspawn, *(entities[i] for i in sorted(changed_entities))])
+        sliced = slice_map_into_tiles(changed_map)
+
+        # groups merged while slicing could reach tiles that are far from any change,
+        # entities that are left out of groups could go to these tiles
+        sliced_grid = BrushGrid()
+        for tile in sliced:
+            bbox = tile_xy_bbox(tile)
+            if bbox is not None:
+                sliced_grid.add(tile, bbox)
+        for ent_idx in changed_entities:
+            if entities[ent_idx].params["classname"] != "info_tile":
+                for bbox in entity_bbox(entities[ent_idx]):
+                    sliced_grid.add(entities[ent_idx], bbox)
+
+        reached = [tile_idx for tile_idx, (_, _, bbox) in reused.items()
+                   if any(is_xy_overlap(bbox, other_bbox, expand=31)
+                          for _, other_bbox in sliced_grid.query(expand_xy(bbox, 2 * 31)))]
+        if len(reached) == 0:
+            break
+        for tile_idx in reached:
+            tile_brushes, tile_entities, _ = reused.pop(tile_idx)
+            changed_brushes.update(tile_brushes)
+            changed_entities.update(tile_entities)
+
+    # Tiles are ordered by their first brush, same as in `slice_map_into_tiles()`
+    tiles = [(previous[tile_idx][0], tile_brushes) for tile_idx, (tile_brushes, _, _) in reused.items()]
+    tiles += with_brush_indexes(map_, sliced)
+
+    log.info("reused tiles: %d, sliced again: %d", len(reused), len(tiles) - len(reused))
+    return sorted(tiles, key=lambda x: min(x[1]))
 
 
 def divide_tiles(tiles):
+    """Divides checked tiles [(tile, name, TileInfo)] into start, cap and other tiles"""
     start_tiles = []
     cap_tiles = []
     other_tiles = []
-    for tile in tiles:
-        count = 0
-        for ent in tile.entities:
-            if ent.params.get("classname") == "info_player_start":
-                start_tiles.append((tile, "group_tile"))
-                break
-            if ent.params.get("classname") == "info_connector":
-                count += 1
+    for tile, name, info in tiles:
+        if any(ent.params.get("classname") == "info_player_start" for ent in tile.entities):
+            start_tiles.append((tile, name, info))
+        elif len(info.connectors) == 1:
+            cap_tiles.append((tile, name, info))
         else:
-            if count == 1:
-                cap_tiles.append((tile, "group_tile"))
-            else:
-                other_tiles.append((tile, "group_tile"))
+            other_tiles.append((tile, name, info))
 
     return start_tiles, cap_tiles, other_tiles
 
@@ -460,7 +1266,171 @@ def auto_name_connectors(tiles):
                         ent.params["name"] = f"auto_name__{size}"
 
 
-def main():
+def load_group_tiles(path):
+    """Parses group-map, slices it into tiles and names their connectors.
+
+    Result is cached on disk, so it's done only when the map (or the code) changes.
+    When the map is changed, only changed tiles are sliced again (see `INCREMENTAL_SLICING`)
+    """
+    def build():
+        with instrument.timer("parse"):
+            map_ = p.parse_map(open(path), lazy=LAZY_PARSING)
+        slices_kind = "slices-lazy" if LAZY_PARSING else "slices"
+        previous = tile_cache.load_last(slices_kind, path, ["tiles/empty.map"]) if INCREMENTAL_SLICING else None
+        with instrument.timer("slice"):
+            if previous is None:
+                sliced = with_brush_indexes(map_, slice_map_into_tiles(map_))
+            else:
+                sliced = reslice_map_into_tiles(map_, previous)
+        # saved before connectors are named, so names are given the same way as for the full slicing
+        tile_cache.save_last(slices_kind, path, sliced, ["tiles/empty.map"])
+
+        tiles = [tile for tile, _ in sliced]
+        with instrument.timer("auto-name"):
+            auto_name_connectors(tiles)
+        return tiles
+
+    kind = "group_tiles-lazy" if LAZY_PARSING else "group_tiles"
+    return tile_cache.cached(kind, [path, "tiles/empty.map"], build)
+
+
+TileInfo = namedtuple("TileInfo", "bbox worldspawn_bbox connectors brush_count")
+ConnectorInfo = namedtuple("ConnectorInfo", "idx name center angle")
+
+
+def outward_angles(bbox, point):
+    """Angles of sides of `bbox` (on XY plane) nearest to `point`, connector there usually faces one of them"""
+    (min_x, max_x), (min_y, max_y), _ = bbox
+    x, y, _ = point
+    distances = {0: abs(max_x - x), 90: abs(max_y - y), 180: abs(x - min_x), 270: abs(y - min_y)}
+    nearest = min(distances.values())
+    return [angle for angle, distance in distances.items() if distance == nearest]
+
+
+def preflight_tile(tile):
+    """Checks tile before generator uses it and fixes what can be fixed in place:
+        - exact copies of a brush are removed (they intersect each other)
+        - connector must be a single brush
+        - connector must have right angle rotation. Nearest side of the tile can't tell where
+          connector should face (plugs face their own body, L-shaped tiles have inner corners),
+          so missing or invalid rotation isn't guessed and connector that doesn't face the nearest
+          side is only logged (DEBUG)
+
+    Returns (TileInfo, problems), tile with problems can't be used
+    """
+    problems = []
+
+    keys = set()
+    brushes = []
+    for brush in tile.worldspawn.brushes:
+        key = brush_key(brush)
+        if key not in keys:
+            keys.add(key)
+            brushes.append(brush)
+    if len(brushes) != len(tile.worldspawn.brushes):
+        log.warning("removed %d duplicated brushes", len(tile.worldspawn.brushes) - len(brushes))
+        tile.worldspawn.brushes = brushes
+
+    tile_brushes = gather_brushes(tile)
+    bbox = union_bbox(min_max(brush) for brush in tile_brushes)
+    worldspawn_bbox = union_bbox(min_max(brush) for brush in tile.worldspawn.brushes)
+    room_bbox = worldspawn_bbox or bbox
+
+    connectors = []
+    for idx, ent in get_connectors(tile):
+        name = ent.params.get("name")
+        if len(ent.brushes) != 1:
+            problems.append(f"connector {name} has {len(ent.brushes)} brushes")
+            continue
+
+        con_center = center(ent)
+        try:
+            angle = int(ent.params["angles"].split()[1]) % 360
+        except (KeyError, IndexError, ValueError):
+            angle = None
+
+        if angle is None or angle % 90 != 0:
+            problems.append(f"connector {name} at {con_center} has invalid rotation {ent.params.get('angles')!r}, "
+                            f"it should be \"0 <yaw> 0\" where yaw is 0, 90, 180 or 270")
+            continue
+
+        if room_bbox is not None and log.isEnabledFor(logging.DEBUG):
+            sides = outward_angles(room_bbox, con_center)
+            if angle not in sides:
+                log.debug("connector %s at %s faces %d, but the nearest side of the tile is %s, "
+                          "it's fine for plugs and tiles that aren't rectangular",
+                          name, con_center, angle, " or ".join(map(str, sides)))
+
+        connectors.append(ConnectorInfo(idx, name, con_center, angle))
+
+    return TileInfo(bbox, worldspawn_bbox, connectors, len(tile_brushes)), problems
+
+
+def preflight_tiles(tiles, name):
+    """Runs `preflight_tile()` for every tile sliced from group-map `name`.
+
+    Returns [(tile, tile name, TileInfo)] of tiles that can be used, tile is named by
+    its group-map and its index in slicing order, e.g. "tileset#007"
+    """
+    checked = []
+    for i, tile in enumerate(tiles):
+        tile_name = f"{name}#{i:03}"
+        info, problems = preflight_tile(tile)
+        if problems:
+            log.warning("tile %s rejected: %s", tile_name, "; ".join(problems))
+            continue
+        if len(info.connectors) == 0:
+            log.warning("Tile %s doesn't have info_connector", tile_name)
+        checked.append((tile, tile_name, info))
+    return checked
+
+
+def load_checked_tiles(path):
+    """Tiles of group-map that passed preflight with their names and TileInfo, cached with the tileset"""
+    def build():
+        tiles = load_group_tiles(path)
+        with instrument.timer("preflight"):
+            return preflight_tiles(tiles, Path(path).stem)
+
+    kind = "preflight-lazy" if LAZY_PARSING else "preflight"
+    return tile_cache.cached(kind, [path, "tiles/empty.map"], build)
+
+
+GeneratorTiles = namedtuple("GeneratorTiles", "start_tiles cap_tiles tiles empty crates catalog cap_catalog crates_catalog")
+
+
+def load_generator_tiles():
+    """Loads everything `generate()` needs, it's enough to do it once for any number of maps"""
+    checked = load_checked_tiles("tiles/test_group_tileset2.map")
+    log.info("preflight: %d tiles, %d brushes, %d connectors", len(checked),
+             sum(info.brush_count for _, _, info in checked), sum(len(info.connectors) for _, _, info in checked))
+
+    start_tiles, cap_tiles, tiles = divide_tiles(checked)
+
+    log.info("start_tiles: %d", len(start_tiles))
+    log.info("  cap_tiles: %d", len(cap_tiles))
+    log.info("      tiles: %d", len(tiles))
+
+    # exit(1)
+
+    # tilesets = load_tiles(Path("./tilesets"))
+    # start_tiles, cap_tiles, tiles = tilesets["simple"]
+    empty = tile_cache.parse_map("tiles/empty.map")
+
+    xxx_crates = tile_cache.parse_map("tilesets/simple/crates_empty.map", lazy=LAZY_PARSING)
+    log.debug("xxx_crates %d", len(xxx_crates.worldspawn.brushes))
+    crates_info, problems = preflight_tile(xxx_crates)
+    if problems:
+        log.warning("crates tile: %s", "; ".join(problems))
+    #input()
+
+    with instrument.timer("catalog"):
+        catalogs = TileCatalog(tiles), TileCatalog(cap_tiles), TileCatalog([(xxx_crates, "crates_empty.map", crates_info)])
+
+    return GeneratorTiles(start_tiles, cap_tiles, tiles, empty, xxx_crates, *catalogs)
+
+
+def main(generator_tiles=None):
     if LOCK_SEED:
         seed = 1337
         random.seed(seed)
@@ -468,172 +1438,235 @@ def main():
         seed = OVERRIDE_SEED
     else:
         seed = random.randint(100_000_000, 999_999_999)
-    random.seed(seed)
 
-    map_ = p.parse_map(open("tiles/test_group_tileset2.map"))
-    tiles = slice_map_into_tiles(map_)
-    auto_name_connectors(tiles)
+    return generate(seed, generator_tiles or load_generator_tiles())
 
-    for tile in tiles:
-        if not check_tile_has_connector(tile):
-            print("Tile doesn't have info_connector")
 
-    start_tiles, cap_tiles, tiles = divide_tiles(tiles)
+def tile_candidates(generator_tiles, ent, counter):
+    """Placements of tiles that could fill connector `ent` in the order they are tried"""
+    catalog = generator_tiles.catalog if counter < TILE_LIMIT else generator_tiles.cap_catalog
+    candidates = catalog.candidates(ent)
+    if ent.params["name"] == "crates":
+        # when nothing fits, fill the room with crates
+        candidates = chain(candidates, generator_tiles.crates_catalog.candidates(ent))
+    return candidates
 
-    print("start_tiles:", len(start_tiles))
-    print("  cap_tiles:", len(cap_tiles))
-    print("      tiles:", len(tiles))
 
-    # exit(1)
+def place_tile(root, ent, candidates, counter):
+    """Merges first of `candidates` that fits into the root at connector `ent`.
 
-    # tilesets = load_tiles(Path("./tilesets"))
-    # start_tiles, cap_tiles, tiles = tilesets["simple"]
-    root = p.parse_map(open("tiles/empty.map"))
+    Returns name of placed tile, None if none of them fits
+    """
+    con_a = center(ent)
+
+    for candidate in candidates:
+        tile_name = candidate.tile_name
+        log.debug("candidate: %s, rotation %s", tile_name, candidate.deg)
+        instrument.tile_event(tile_name, "attempt")
+
+        vec = vec_diff(con_a, candidate.offset)
+        with instrument.timer("boundary"):
+            is_outside = is_outside_world_boundry(p.transform_bbox(candidate.worldspawn_bbox, vec=vec)
+                                                  if candidate.worldspawn_bbox else None)
+        if is_outside:
+            log.debug("  outside world boundry %s", tile_name)
+            instrument.tile_event(tile_name, "outside world boundry")
+            continue
 
-    xxx_crates = p.parse_map(open("tilesets/simple/crates_empty.map"))
-    print("xxx_crates", len(xxx_crates.worldspawn.brushes))
-    #input()
+        tile_bbox = p.transform_bbox(candidate.bbox, vec=vec) if candidate.bbox else None
+        placement = Placement(candidate.tile, tile_bbox).rotate(candidate.deg).move(vec)
+
+        # Now that new tile is in place, we have to check
+        # for brush collision before merging
+        with instrument.timer("intersection"):
+            is_intersect = is_tile_intersect(root, placement)
+        if is_intersect:
+            # tile didn't fit, choose different tile
+            log.debug("  intersection %s", tile_name)
+            instrument.tile_event(tile_name, "intersection")
+            continue
+
+        instrument.tile_event(tile_name, "placed")
+        break # good tile fits perfectly
+    else:
+        log.debug("ent %r connector_name: %s", ent, ent.params["name"])
+        return None
+
+    # only now, when we know that tile fits, make a copy of it
+    tmp_tile = placement.materialize()
+
+    # remove connectors
+    root.remove_entities([ent])
+    tmp_tile.entities.pop(candidate.connector_idx)
+    log.debug("connectors_to_remove: %r %s", ent, candidate.connector_idx)
+
+    log.debug("merge tile  - %s", tile_name)
+    rename_entities(tmp_tile, counter)
 
-    # first tile
-    start_tile = random.choice(start_tiles)[0]
+    # trying to not break seeds, by storing state
+    rnd_state = random.getstate()
+    apply_entity_mapgen_choice(tmp_tile)
+    random.setstate(rnd_state)
+
+    with instrument.timer("merge"):
+        root.merge(tmp_tile)
+
+    # Find extra overlaping connectors:
+    with instrument.timer("mating"):
+        closed_loops = mate_connectors(root)
+    if closed_loops > 0:
+        log.debug("closed loops: %d", closed_loops)
+        instrument.count("closed loops", closed_loops)
+
+    return tile_name
+
+
+def generate(seed, generator_tiles, out_path="out.map"):
+    """Generates map from `generator_tiles` (they are not modified) and saves it to `out_path`.
+
+    When no tile fits to a connector, last placed tiles are removed one by one and their
+    connectors are filled with other tiles (see `BACKTRACK_DEPTH`, `BACKTRACK_LIMIT`)
+    """
+    random.seed(seed)
+
+    with instrument.timer("deepcopy"):
+        root = RootMap(copy.deepcopy([generator_tiles.empty.worldspawn, *generator_tiles.empty.entities]))
+
+        # first tile
+        start_tile = copy.deepcopy(random.choice(generator_tiles.start_tiles)[0])
     rename_entities(start_tile, 0)
-    root.merge(start_tile)
+    with instrument.timer("merge"):
+        root.merge(start_tile)
 
     # Iterate over connectors until all a filled
-    print("Root Connectors:")
 
     counter = 0
     success = True
     tile_stats = []
+    steps = [] # last placements that can be undone: (undo mark, connector, candidates left, counter)
+    backtracks = 0
 
     while True:
-        counter += 1
-
-        print("-"*20)
-
-        root_connectors = get_connectors(root)
-        print("loop, number of connectors:", len(root_connectors))
+        root_connectors = root.connector_index
+        log.debug("loop %d, number of connectors: %d", counter + 1, len(root_connectors))
 
         if len(root_connectors) == 0:
             break
 
-        idx_a, ent = random.choice(root_connectors)
-
-        # print(ent.params)
-        con_a = center(ent)
-        # print("center:", con_a)
-        angle_a = get_angle(ent)
-
-        # Choose tile
-        # TODO: instead of range(10) enumerate tiles and connectors and go thru them.
-        #       When there is 1 tile with 2 connectors, this loop needlesly tries and fails 10 times
-        for _ in range(10):
-            is_could_not_place_tile = False
-            is_intersect_fail = False
-
-            if ent.params["name"] == "crates" and _ > 7:
-                print("CARATEAS")
-                tile = xxx_crates
-                tile_name = "crates_empty.map"
-                print("debug:", tile_name, len(tile.worldspawn.brushes))
-                #time.sleep(2)
-            else:
-                tile, tile_name = random.choice(tiles if counter < TILE_LIMIT else cap_tiles)
+        counter += 1
+        ent = random.choice(root_connectors)
+
+        # Choose tile: go thru every tile, connector and rotation that fits until one is placed
+        candidates = tile_candidates(generator_tiles, ent, counter)
+        mark = root.mark()
+        tile_name = place_tile(root, ent, candidates, counter)
+
+        # Nothing fits, so undo last placement and place the next candidate there instead
+        while tile_name is None and len(steps) > 0 and backtracks < BACKTRACK_LIMIT:
+            backtracks += 1
+            mark, ent, candidates, counter = steps.pop()
+            root.undo(mark)
+            del tile_stats[counter - 1:]
+            log.debug("backtrack to tile %d", counter)
+            instrument.count("backtracks")
+            tile_name = place_tile(root, ent, candidates, counter)
+
+        if tile_name is None:
+            catalog = generator_tiles.catalog if counter < TILE_LIMIT else generator_tiles.cap_catalog
+            if ent.params["name"] not in catalog.names:
+                log.warning("No connectors with name %s", ent.params["name"])
+            # other open connectors with the same name most likely can't be filled either
+            log.warning("Could not place any tile, %d open connectors named %s are left",
+                        len(root.connector_index.get(ent.params["name"])), ent.params["name"])
+            instrument.count("could not place tile")
+            success = False
+            break
 
-            tmp_tile = copy.deepcopy(tile)
-            print("debug:", tile_name, len(tmp_tile.worldspawn.brushes))
+        tile_stats.append(tile_name)
+        steps.append((mark, ent, candidates, counter))
+        del steps[:-BACKTRACK_DEPTH]
 
-            connectors = get_connectors(tmp_tile, ent.params["name"])
-            if len(connectors) == 0:
-                print("No connectors with name", ent.params["name"])
-                # TODO: meaningful error when we had too many tries fail
-                continue
+    # map is complete, drop removed connectors before going thru all entities
+    root.compact()
+    apply_special_count(root)
 
-            idx_b, connector = random.choice(connectors)
-            angle_b = get_angle(connector)
-            # print("angle math:")
-            # print("  angle_a: ", angle_a)
-            # print("  angle_b: ", angle_b)
-            # print("  angle_a - angle_b: ", angle_a - angle_b)
-            ang = (180 - (angle_a - angle_b) ) % 360
-            # print("  (180 - abs(angle_a - angle_b) ) % 360: ", ang)
-            tmp_tile.rotate(ang)
-            con_b = center(connector)
-
-            tmp_tile.move(vec_diff(con_a, con_b))
-
-            # Now that new tile is in place, we have to check
-            # for brush collision before merging
-            print("debug:", tile_name, len(tmp_tile.worldspawn.brushes))
-            if is_tile_intersect(root, tmp_tile):
-                # tile didn't fit
-                # choose different tile
-                # todo: try different connector
-                is_intersect_fail = True
-                print("  intersection", tile_name)
-                continue
+    dangling = root.name_index.dangling()
+    if dangling:
+        log.warning("Targets without entity: %s", ", ".join(dangling))
+        instrument.count("dangling targets", len(dangling))
 
-            if is_outside_world_boundry(tmp_tile):
-                is_could_not_place_tile = True
-                print("  outside world boundry", tile_name)
-                continue
+    log.info("Saving map to %s", out_path)
+    with instrument.timer("write"):
+        root.write(out_path)
+    log.info("Seed used: %s", seed)
 
-            break # good tile fits perfectly
-        else:
-            is_could_not_place_tile = True
-            print("ent", repr(ent), connectors, "connector_name:", ent.params["name"], ent.brushes[0].faces[0].points)
+    return success, tile_stats
 
 
-        if is_could_not_place_tile:
-            print("error: Could not place any tile")
-            success = False
-            break
+_worker_generator_tiles = None
 
 
-        # remove connectors
-        if not is_intersect_fail:
-            root.entities.pop(idx_a)
-            tmp_tile.entities.pop(idx_b)
-            print("connectors_to_remove:", idx_a, idx_b)
-        else:
-            print("keeping connector")
+def _init_batch_worker(generator_tiles, stats):
+    global _worker_generator_tiles
+    _worker_generator_tiles = generator_tiles
+    instrument.ENABLED = stats
+    # failed maps are reported in summary
+    logging.disable(logging.WARNING)
 
 
-        print("merge tile  - ", tile_name)
-        rename_entities(tmp_tile, counter)
+def _generate_batch_job(seed, out_dir, profile):
+    start = time.perf_counter()
+    result = {"seed": seed, "path": str(out_dir / f"{seed}.map")}
+    instrument.reset()
+    profiler = cProfile.Profile() if profile else None
 
-        # trying to not break seeds, by storing state
-        rnd_state = random.getstate()
-        apply_entity_mapgen_choice(tmp_tile)
-        random.setstate(rnd_state)
+    try:
+        if profiler is not None:
+            profiler.enable()
+        try:
+            success, tile_stats = generate(seed, _worker_generator_tiles, result["path"])
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                profiler.dump_stats(out_dir / f"{seed}.prof")
+        result["success"] = success
+        result["tiles"] = len(tile_stats)
+        result["tile_stats"] = dict(Counter(tile_stats))
+    except Exception as e:
+        result["success"] = False
+        result["error"] = repr(e)
 
-        root.merge(tmp_tile)
-        tile_stats.append(tile_name)
+    result["time"] = round(time.perf_counter() - start, 3)
+    if instrument.ENABLED:
+        result["stats"] = instrument.report()
+    return result
 
-        # Find extra overlaping connectors:
-        connectors_to_remove = set()
-        root_connectors = get_connectors(root)
-        for idx, (i, ent) in enumerate(root_connectors):
-            for j, other_ent in root_connectors[idx+1:]:
-                if center(ent) == center(other_ent) and get_angle(ent) == (get_angle(other_ent) + 180) % 360:
-                    connectors_to_remove.add(i)
-                    connectors_to_remove.add(j)
-                    continue
 
-        root.entities = [ent for i, ent in enumerate(root.entities) if i not in connectors_to_remove]
+def generate_batch(seeds, out_dir=Path("out"), workers=None, stats=False, profile=False):
+    """Generates map for every seed in `workers` processes, maps are saved to `out_dir/<seed>.map`.
 
-        if is_intersect_fail:
-            print("breaking gen early")
-            success = False
-            break
+    Tiles are loaded only once and shared with workers. Summary of every map is returned
+    and also saved to `out_dir/summary.json`. With `stats` summary includes timings and counters
+    of every map (see `instrument`), with `profile` cProfile stats are saved to `out_dir/<seed>.prof`
+    """
+    generator_tiles = load_generator_tiles()
+    out_dir.mkdir(parents=True, exist_ok=True)
 
-    apply_special_count(root)
+    with ProcessPoolExecutor(workers, initializer=_init_batch_worker, initargs=(generator_tiles, stats)) as executor:
+        summary = list(executor.map(_generate_batch_job, seeds, repeat(out_dir), repeat(profile)))
 
-    print("Saving map to out.map")
-    root.write("out.map")
-    print("Seed used:", seed)
+    with open(out_dir / "summary.json", "w") as f:
+        json.dump(summary, f, indent=2)
+
+    return summary
 
-    return success, tile_stats
+
+def parse_seeds(s):
+    """`1000-1999` (inclusive) or `1000`"""
+    if "-" in s:
+        first, last = s.split("-")
+        return list(range(int(first), int(last) + 1))
+    return [int(s)]
 
 
 def debug_count_textures(root):
@@ -652,9 +1685,41 @@ def debug_count_textures(root):
     return count
 
 
-if __name__ == '__main__':
+def cli():
+    parser = argparse.ArgumentParser(description="Generates random map from tiles")
+    parser.add_argument("--seeds", type=parse_seeds, help="batch mode: range of seeds to generate, e.g. 1000-1999")
+    parser.add_argument("--count", type=int, help="batch mode: number of maps with random seeds to generate")
+    parser.add_argument("--out", type=Path, default=Path("out"), help="batch mode: directory for generated maps")
+    parser.add_argument("--jobs", type=int, help="batch mode: number of worker processes (default: all cores)")
+    parser.add_argument("--stats", action="store_true", help="save timings of phases and counters to stats.json (batch mode: to summary)")
+    parser.add_argument("--profile", action="store_true", help="save cProfile stats to out.prof (batch mode: to <out>/<seed>.prof)")
+    parser.add_argument("-v", "--verbose", action="store_true", help="log every step of generation")
+    parser.add_argument("-q", "--quiet", action="store_true", help="log only warnings and errors")
+    args = parser.parse_args()
+
+    level = logging.DEBUG if args.verbose else logging.WARNING if args.quiet else logging.INFO
+    logging.basicConfig(level=level, format="%(message)s")
+    instrument.ENABLED = args.stats
+
+    if args.seeds is not None or args.count is not None:
+        seeds = args.seeds or []
+        if args.count is not None:
+            seeds += random.Random().sample(range(100_000_000, 1_000_000_000), args.count)
+
+        summary = generate_batch(seeds, args.out, args.jobs, args.stats, args.profile)
+        for result in summary:
+            status = "ok  " if result["success"] else "FAIL"
+            print(f'{status} {result["seed"]:>10} tiles={result.get("tiles", "-"):>4} {result["time"]:>8.2f}s {result.get("error", "")}')
+        print(f'{sum(r["success"] for r in summary)}/{len(summary)} maps generated, summary: {args.out / "summary.json"}')
+        return
+
+    profiler = cProfile.Profile() if args.profile else None
+    if profiler is not None:
+        profiler.enable()
+
+    generator_tiles = load_generator_tiles()
     for i in range(10):
-        success, stats = main()
+        success, stats = main(generator_tiles)
         # if "ramp.map" in stats:
         #     print("done")
         #     exit()
@@ -662,3 +1727,18 @@ if __name__ == '__main__':
             for k,v in Counter(stats).items():
                 print(k, v)
             break
+
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats("out.prof")
+        print("Profile saved to out.prof")
+    if args.stats:
+        instrument.write_json("stats.json")
+        print("Stats saved to stats.json")
+
+
+if __name__ == '__main__':
+    # run from the imported module, not from `__main__`: classes of this module are pickled into the tile
+    # cache, from `__main__` they couldn't be loaded by other scripts which import the generator
+    import map_gen_v2
+    map_gen_v2.cli()
@@ -1,6 +1,14 @@
 
 import re
 import io
+import gzip
+import logging
+import sys
+from array import array
+from functools import lru_cache
+from itertools import chain
+
+log = logging.getLogger(__name__)
 
 # from python docs: https://docs.python.org/3/library/re.html#simulating-scanf
 FLOAT_REGEX = r'[-+]?(?:\d+(?:\.\d*)?|\.\d+)(?:[eE][-+]?\d+)?'
@@ -36,6 +44,27 @@ def rotate(point, deg):
     raise Exception('This is unreachable')
 
 
+def transform_bbox(bbox, deg=None, vec=None):
+    """Rotates (same as `rotate()`) and then moves bounding box ((min x, max x), (min y, max y), (min z, max z))"""
+    x, y, z = bbox
+    if deg:
+        deg = deg % 360
+        if deg == 90:
+            x, y = y, (-x[1], -x[0])
+        elif deg == 180:
+            x, y = (-x[1], -x[0]), (-y[1], -y[0])
+        elif deg == 270:
+            x, y = (-y[1], -y[0]), x
+
+    if vec is not None:
+        dx, dy, dz = vec
+        x = (x[0] + dx, x[1] + dx)
+        y = (y[0] + dy, y[1] + dy)
+        z = (z[0] + dz, z[1] + dz)
+
+    return x, y, z
+
+
 def sign(x):
     if x == 0:
         return 0
@@ -45,160 +74,318 @@ def sign(x):
         return -1
 
 
-class Face:
-    def __init__(self, points, texture, texture_attr):
-        self.points = [[float(v) for v in point] for point in points]
-        self.texture = texture
-        self.texture_attr = texture_attr
-
-    def _fmt_point(self, point):
-        return f'( {point[0]} {point[1]} {point[2]} )'
-
-    def __str__(self):
-        # example output:
-        # ( -128 128 0 ) ( 128 128 0 ) ( 128 -128 0 ) CRETE4_FLR03 [ 1 0 0 0 ] [ 0 -1 0 0 ] 0 1 1 
-        attr = self.texture_attr
-        return (
-            ' '.join(self._fmt_point(p) for p in self.points) +
-            f' {self.texture} '
-            f"[ {' '.join(str(v) for v in attr['tex-point-1'])} {attr['offset-x']} ] "
-            f"[ {' '.join(str(v) for v in attr['tex-point-2'])} {attr['offset-y']} ] "
-            f"{attr['degree']} {attr['scale-x']} {attr['scale-y']}"
-        )
+# Brush faces are stored in one flat `array('d')` per brush, FACE_SIZE numbers per face,
+# in the same order as they are written in `.map` file (texture name is stored separately):
+#   ( x1 y1 z1 ) ( x2 y2 z2 ) ( x3 y3 z3 ) TEXTURE [ tx1 ty1 tz1 offset-x ] [ tx2 ty2 tz2 offset-y ] degree scale-x scale-y
+FACE_SIZE = 20
+POINTS = 0
+TEX_POINT_1 = 9
+OFFSET_X = 12
+TEX_POINT_2 = 13
+OFFSET_Y = 16
+DEGREE = 17
+SCALE_X = 18
+SCALE_Y = 19
+
+FACE_FORMAT = '( {} {} {} ) ( {} {} {} ) ( {} {} {} ) {} [ {} {} {} {} ] [ {} {} {} {} ] {} {} {}'
+
+
+# About texture move: I have no idea what `tex-point` means, I just looked at differences in ".map" file and wrote rules accordingly
+# This definitly doesn't work for brushes with not-right-angles (brushes rotated by 45 degrees etc.)
+#
+# (tex-point-1, tex-point-2) -> (axis of move vector, +1 if offset is increased or -1 if decreased)
+# tex-point-2 = None means any
+OFFSET_X_MOVE_RULES = {
+    # X Texture Move
+    ((-1, 0, 0), (0, -1, 0)): (0, 1),
+    ((1, 0, 0), (0, -1, 0)): (0, -1),
+    ((-1, 0, 0), (0, 0, -1)): (0, 1),
+    ((1, 0, 0), (0, 0, -1)): (0, -1),
+    # Y Texture Move
+    ((0, 1, 0), None): (1, -1),
+    ((0, -1, 0), None): (1, 1),
+    # Z texture move
+    ((0, 0, -1), (0, 1, 0)): (2, 1),
+    ((0, 0, 1), (0, 1, 0)): (2, -1),
+}
+OFFSET_Y_MOVE_RULES = {
+    # Y Texture Move
+    ((1, 0, 0), (0, -1, 0)): (1, 1),
+    ((-1, 0, 0), (0, -1, 0)): (1, 1),
+    # Z texture move
+    # possibly not needed? (added by mistake)
+    ((1, 0, 0), (0, 0, -1)): (2, 1),
+    # possibly not needed? (added by mistake)
+    ((-1, 0, 0), (0, 0, -1)): (2, 1),
+    ((0, 1, 0), (0, 0, -1)): (2, 1),
+    ((0, -1, 0), (0, 0, -1)): (2, 1),
+}
+
+
+@lru_cache(maxsize=4096)
+def texture_move_rule(tex_points):
+    """For face with `tex_points` = (*tex-point-1, *tex-point-2) returns rules for offset-x and offset-y (or None)"""
+    tex_point_1 = tex_points[:3]
+    tex_point_2 = tex_points[3:]
+    offset_x = OFFSET_X_MOVE_RULES.get((tex_point_1, tex_point_2)) or OFFSET_X_MOVE_RULES.get((tex_point_1, None))
+    offset_y = OFFSET_Y_MOVE_RULES.get((tex_point_1, tex_point_2))
+    return offset_x, offset_y
+
+
+def _negated(values):
+    return array('d', [-v for v in values])
+
+
+def _moved_offset(offset, scale, rule, vec):
+    if rule is None:
+        return offset
+
+    axis, direction = rule
+    if direction > 0:
+        return offset + vec[axis] * sign(scale)
+    return offset - vec[axis] * sign(scale)
+
+
+def transform_faces(data, deg=None, vec=None):
+    """Rotates by `deg` and then moves by `vec` all faces stored in flat `data` array (see `Brush.data`).
+
+    `data` can hold faces of many brushes, every step is done on whole columns of the array
+    (all x1, all tex-point-1...) instead of face by face.
+    """
+    if deg:
+        right_angle = deg % 360
+        for i in range(POINTS, TEX_POINT_1, 3):
+            xs = data[i::FACE_SIZE]
+            ys = data[i+1::FACE_SIZE]
+            # same as `rotate()`
+            if right_angle == 90:
+                data[i::FACE_SIZE], data[i+1::FACE_SIZE] = ys, _negated(xs)
+            elif right_angle == 180:
+                data[i::FACE_SIZE], data[i+1::FACE_SIZE] = _negated(xs), _negated(ys)
+            elif right_angle == 270:
+                data[i::FACE_SIZE], data[i+1::FACE_SIZE] = _negated(ys), xs
+
+        if deg % 180 == 90:
+            for i in (TEX_POINT_1, TEX_POINT_2):
+                data[i::FACE_SIZE], data[i+1::FACE_SIZE] = data[i+1::FACE_SIZE], data[i::FACE_SIZE]
+
+        # flip texture if it's lying on the face perpendicular to an axis
+        for axis, flip_degs in ((0, (180, 90)), (1, (180, 270))):
+            if deg in flip_degs:
+                data[SCALE_X::FACE_SIZE] = array('d', [
+                    -scale if a == 0 and b == 0 else scale
+                    for scale, a, b in zip(
+                        data[SCALE_X::FACE_SIZE],
+                        data[TEX_POINT_1+axis::FACE_SIZE],
+                        data[TEX_POINT_2+axis::FACE_SIZE],
+                    )
+                ])
+
+    if vec is not None:
+        for i in range(POINTS, TEX_POINT_1):
+            delta = vec[i % 3]
+            data[i::FACE_SIZE] = array('d', [v + delta for v in data[i::FACE_SIZE]])
+
+        rules = [texture_move_rule(tex_points) for tex_points in zip(
+            data[TEX_POINT_1::FACE_SIZE], data[TEX_POINT_1+1::FACE_SIZE], data[TEX_POINT_1+2::FACE_SIZE],
+            data[TEX_POINT_2::FACE_SIZE], data[TEX_POINT_2+1::FACE_SIZE], data[TEX_POINT_2+2::FACE_SIZE],
+        )]
+        for rule_idx, offset_column, scale_column in ((0, OFFSET_X, SCALE_X), (1, OFFSET_Y, SCALE_Y)):
+            data[offset_column::FACE_SIZE] = array('d', [
+                _moved_offset(offset, scale, rule[rule_idx], vec)
+                for offset, scale, rule in zip(data[offset_column::FACE_SIZE], data[scale_column::FACE_SIZE], rules)
+            ])
+
+    return data
+
+
+class _FloatStrings(dict):
+    """Memoized `str()` of floats, maps are mostly made of the same few numbers"""
+    def __missing__(self, value):
+        if len(self) > 100_000:
+            self.clear()
+        s = self[value] = str(value)
+        return s
 
 
-class Brush:
-    def __init__(self, brush_str):
-        names = 'x1 y1 z1 x2 y2 z2 x3 y3 z3 texture tx1 ty1 tz1 offset-x tx2 ty2 tz2 offset-y degree scale-x scale-y'.split()
-
-        faces = list()
-        for line in brush_str.split('\n'):
-            #m = BRUSH_FACE_REGEXP.match(line)
-            if line in "{}":
-                continue
+_float_strings = _FloatStrings()
+_NEGATIVE_ZERO = array('d', [-0.0]).tobytes()
 
-            m = line.replace('(', '').replace(')', '').replace('[', '').replace(']', '')
-            m = m.split()
 
-            #m = BRUSH_FACE_REGEXP.findall(line)
+@lru_cache(maxsize=64)
+def _brush_format(faces_count):
+    """Format string for all faces of a brush, takes all numbers of `Brush.data` followed by all textures"""
+    lines = []
+    for face in range(faces_count):
+        fields = [face * FACE_SIZE + i for i in range(FACE_SIZE)]
+        # texture goes after 3 points
+        fields.insert(TEX_POINT_1, faces_count * FACE_SIZE + face)
+        lines.append(FACE_FORMAT.replace('{}', '{%d}') % tuple(fields))
+    return '\n'.join(lines)
 
-            if len(m) != len(names):
-                print('===[ Error ]===')
-                print("line:", line)
-                print("length:", len(m), len(names))
-                print("m:", m)
-                exit(42)
 
-            data = dict(zip(names, m))
-            # print(data)
-
-            points = [
-                (data['x1'], data['y1'], data['z1'],),
-                (data['x2'], data['y2'], data['z2'],),
-                (data['x3'], data['y3'], data['z3'],),
-            ]
+class Face:
+    """Lightweight view of a single face inside of `Brush.data`.
+
+    NOTE: `points` and `texture_attr` are built on access, modifying them doesn't change the brush
+    """
+    __slots__ = ('brush', 'index')
+
+    def __init__(self, brush, index):
+        self.brush = brush
+        self.index = index
+
+    @property
+    def _offset(self):
+        return self.index * FACE_SIZE
+
+    @property
+    def points(self):
+        i = self._offset
+        data = self.brush.data
+        return [data[i:i+3].tolist(), data[i+3:i+6].tolist(), data[i+6:i+9].tolist()]
+
+    @property
+    def texture(self):
+        return self.brush.textures[self.index]
+
+    @property
+    def texture_attr(self):
+        i = self._offset
+        data = self.brush.data
+        return {
+            'tex-point-1': data[i+TEX_POINT_1:i+TEX_POINT_1+3].tolist(),
+            'tex-point-2': data[i+TEX_POINT_2:i+TEX_POINT_2+3].tolist(),
+            'offset-x': data[i+OFFSET_X],
+            'offset-y': data[i+OFFSET_Y],
+            'degree': data[i+DEGREE],
+            'scale-x': data[i+SCALE_X],
+            'scale-y': data[i+SCALE_Y],
+        }
 
-            texture_attributes = {
-                'tex-point-1': [float(v) for v in [data['tx1'], data['ty1'], data['tz1']]],
-                'tex-point-2': [float(v) for v in [data['tx2'], data['ty2'], data['tz2']]],
-            }
-            for k in ['offset-x', 'offset-y', 'degree', 'scale-x', 'scale-y']:
-                texture_attributes[k] = float(data[k])
+    def __str__(self):
+        # example output:
+        # ( -128 128 0 ) ( 128 128 0 ) ( 128 -128 0 ) CRETE4_FLR03 [ 1 0 0 0 ] [ 0 -1 0 0 ] 0 1 1 
+        i = self._offset
+        data = self.brush.data
+        return FACE_FORMAT.format(*data[i:i+TEX_POINT_1], self.texture, *data[i+TEX_POINT_1:i+FACE_SIZE])
 
-            faces.append(Face(points, data['texture'], texture_attributes))
 
-        self.faces = faces
+class Brush:
+    __slots__ = ('data', 'textures', '_bbox')
+
+    def __init__(self, data, textures):
+        """`data` is `array('d')` with FACE_SIZE numbers per face, `textures` - texture name per face"""
+        assert len(data) == len(textures) * FACE_SIZE
+        self.data = data
+        self.textures = textures
+        self._bbox = None
+
+    @property
+    def faces(self):
+        return [Face(self, i) for i in range(len(self.textures))]
+
+    def min_max(self):
+        """Bounding box of the brush, see `map_gen_v2.min_max()`.
+
+        It is calculated once and then kept up to date by `move()`, `rotate()` and `Map.transform()`
+        """
+        if self._bbox is None:
+            data = self.data
+            bbox = []
+            for axis in range(3):
+                # keep the same order of points as they are in faces: p1, p2, p3, p1, p2...
+                values = list(chain.from_iterable(zip(
+                    data[POINTS+axis::FACE_SIZE],
+                    data[POINTS+3+axis::FACE_SIZE],
+                    data[POINTS+6+axis::FACE_SIZE],
+                )))
+                bbox.append((min(values), max(values)))
+            self._bbox = tuple(bbox)
+
+        return self._bbox
+
+    def plane_points(self):
+        """Three points of every face plane: [((x1, y1, z1), (x2, y2, z2), (x3, y3, z3)), ...]"""
+        data = self.data
+        return [(tuple(data[i:i+3]), tuple(data[i+3:i+6]), tuple(data[i+6:i+9]))
+                for i in range(POINTS, len(data), FACE_SIZE)]
+
+    def _transform_bbox(self, deg=None, vec=None):
+        if self._bbox is not None:
+            self._bbox = transform_bbox(self._bbox, deg, vec)
 
     def move(self, vec):
-        for face in self.faces:
-            for p in face.points:
-                p[0] += vec[0]
-                p[1] += vec[1]
-                p[2] += vec[2]
-
-            # TODO:
-            # # tex-point is vector along the face of the texture, it precisesly describe texture rotation on the face. But fails to communicate normal vector
-            # tex_point = [a+b for a,b in zip(face.texture_attr['tex-point-1'], face.texture_attr['tex-point-2'])]
-
-            # # TODO: This covers X coordinate, but I fail to understand when to descrese offset and when to increase
-            # if tex_point[1] == 0 or tex_point[2] == 0:
-            #     pass
-
-            # continue
-
-            # About texture move: I have no idea what `tex-point` means, I just looked at differences in ".map" file and wrote ifs accordingly
-            # This definitly doesn't work for brushes with not-right-angles (brushes rotated by 45 degrees etc.)
-
-            sign_x = sign(face.texture_attr['scale-x'])
-            sign_y = sign(face.texture_attr['scale-y'])
-
-            # X Texture Move
-            if face.texture_attr['tex-point-1'] == [-1, 0, 0] and face.texture_attr['tex-point-2'] == [0, -1, 0]:
-                face.texture_attr['offset-x'] += vec[0] * sign_x
-            if face.texture_attr['tex-point-1'] == [1, 0, 0] and face.texture_attr['tex-point-2'] == [0, -1, 0]:
-                face.texture_attr['offset-x'] -= vec[0] * sign_x
-            if face.texture_attr['tex-point-1'] == [-1, 0, 0] and face.texture_attr['tex-point-2'] == [0, 0, -1]:
-                face.texture_attr['offset-x'] += vec[0] * sign_x
-            if face.texture_attr['tex-point-1'] == [1, 0, 0] and face.texture_attr['tex-point-2'] == [0, 0, -1]:
-                face.texture_attr['offset-x'] -= vec[0] * sign_x
-
-            # Y Texture Move
-            if face.texture_attr['tex-point-1'] == [0, 1, 0]:
-                face.texture_attr['offset-x'] -= vec[1] * sign_x
-            if face.texture_attr['tex-point-1'] == [0, -1, 0]:
-                face.texture_attr['offset-x'] += vec[1] * sign_x
-            if face.texture_attr['tex-point-1'] == [1, 0, 0] and face.texture_attr['tex-point-2'] == [0, -1, 0]:
-                face.texture_attr['offset-y'] += vec[1] * sign_y
-            if face.texture_attr['tex-point-1'] == [-1, 0, 0] and face.texture_attr['tex-point-2'] == [0, -1, 0]:
-                face.texture_attr['offset-y'] += vec[1] * sign_y
-
-            # Z texture move
-            if face.texture_attr['tex-point-1'] == [0, 0, -1] and face.texture_attr['tex-point-2'] == [0, 1, 0]:
-                face.texture_attr['offset-x'] += vec[2] * sign_x
-            if face.texture_attr['tex-point-1'] == [0, 0, 1] and face.texture_attr['tex-point-2'] == [0, 1, 0]:
-                face.texture_attr['offset-x'] -= vec[2] * sign_x
-            # possibly not needed? (added by mistake)
-            if face.texture_attr['tex-point-1'] == [1, 0, 0] and face.texture_attr['tex-point-2'] == [0, 0, -1]:
-                face.texture_attr['offset-y'] += vec[2] * sign_y
-            # possibly not needed? (added by mistake)
-            if face.texture_attr['tex-point-1'] == [-1, 0, 0] and face.texture_attr['tex-point-2'] == [0, 0, -1]:
-                face.texture_attr['offset-y'] += vec[2] * sign_y
-            if face.texture_attr['tex-point-1'] == [0, 1, 0] and face.texture_attr['tex-point-2'] == [0, 0, -1]:
-                face.texture_attr['offset-y'] += vec[2] * sign_y
-            if face.texture_attr['tex-point-1'] == [0, -1, 0] and face.texture_attr['tex-point-2'] == [0, 0, -1]:
-                face.texture_attr['offset-y'] += vec[2] * sign_y
-
-
+        transform_faces(self.data, vec=vec)
+        self._transform_bbox(vec=vec)
         return self
 
     def rotate(self, deg):
         assert deg % 90 == 0, 'only right angle rotation is supported'
-
-        if deg == 0:
-            return self
-
-        for face in self.faces:
-            for i, p in enumerate(face.points):
-                face.points[i] = rotate(p, deg)
-
-            if deg % 180 == 90:
-                x,y,z = face.texture_attr['tex-point-1']
-                face.texture_attr['tex-point-1'] = [y,x,z]
-                x,y,z = face.texture_attr['tex-point-2']
-                face.texture_attr['tex-point-2'] = [y,x,z]
-
-            if deg in [180, 90]:
-                if face.texture_attr['tex-point-1'][0] == 0 and face.texture_attr['tex-point-2'][0] == 0:
-                    face.texture_attr['scale-x'] *= -1
-
-            if deg in [180, 270]:
-                if face.texture_attr['tex-point-1'][1] == 0 and face.texture_attr['tex-point-2'][1] == 0:
-                    face.texture_attr['scale-x'] *= -1
-
+        transform_faces(self.data, deg=deg)
+        self._transform_bbox(deg=deg)
         return self
 
     def __str__(self):
-        return '{\n' + '\n'.join(str(f) for f in self.faces) + '\n}'
+        data = self.data
+        if _NEGATIVE_ZERO in data.tobytes():
+            # -0.0 == 0.0, so they can't be told apart by `_float_strings`
+            values = [str(v) for v in data]
+        else:
+            values = map(_float_strings.__getitem__, data)
+        return '{\n' + _brush_format(len(self.textures)).format(*values, *self.textures) + '\n}'
+
+
+class LazyBrush(Brush):
+    """Brush that keeps its face lines as they were read and decodes them only when faces are needed.
+
+    Bounding box is found without decoding all faces and untouched brush is written back as it was read
+    """
+    __slots__ = ('lines',)
+
+    def __init__(self, lines):
+        self.lines = lines # face lines, None once they are decoded
+        self._bbox = None
+
+    def __getattr__(self, name):
+        # called only for slots that are not set yet
+        if name in ('data', 'textures') and self.lines is not None:
+            self.data, self.textures = decode_faces(self.lines)
+            self.lines = None
+            return getattr(self, name)
+        raise AttributeError(name)
+
+    def __getstate__(self):
+        # copy and pickle read every slot, which would decode faces
+        if self.lines is not None:
+            return None, {'lines': self.lines, '_bbox': self._bbox}
+        return None, {'lines': None, '_bbox': self._bbox, 'data': self.data, 'textures': self.textures}
+
+    def min_max(self):
+        if self._bbox is None and self.lines is not None:
+            points = [[], [], []]
+            for line in self.lines:
+                _, values = parse_face(line)
+                for i in range(POINTS, TEX_POINT_1):
+                    points[i % 3].append(float(values[i]))
+            self._bbox = tuple((min(values), max(values)) for values in points)
+
+        return super().min_max()
+
+    def plane_points(self):
+        if self.lines is None:
+            return super().plane_points()
+        faces = []
+        for line in self.lines:
+            _, values = parse_face(line)
+            x1, y1, z1, x2, y2, z2, x3, y3, z3 = map(float, values[POINTS:TEX_POINT_1])
+            faces.append(((x1, y1, z1), (x2, y2, z2), (x3, y3, z3)))
+        return faces
+
+    def __str__(self):
+        if self.lines is not None:
+            return '{\n' + '\n'.join(self.lines) + '\n}'
+        return super().__str__()
 
 
 class Entity:
@@ -214,11 +401,7 @@ class Entity:
         for b in self.brushes:
             b.move(vec)
 
-        if 'origin' in self.params:
-            x,y,z = [float(v) for v in self.params['origin'].split(' ')]
-            dx,dy,dz = vec
-            self.params['origin'] = f'{x+dx} {y+dy} {z+dz}'
-
+        self.move_params(vec)
         return self
 
     def rotate(self, deg):
@@ -226,6 +409,18 @@ class Entity:
             for b in self.brushes:
                 b.rotate(deg)
 
+        self.rotate_params(deg)
+        return self
+
+    def move_params(self, vec):
+        """Moves `origin`, brushes are left untouched"""
+        if 'origin' in self.params:
+            x,y,z = [float(v) for v in self.params['origin'].split(' ')]
+            dx,dy,dz = vec
+            self.params['origin'] = f'{x+dx} {y+dy} {z+dz}'
+
+    def rotate_params(self, deg):
+        """Rotates `origin` and `angles`, brushes are left untouched"""
         if 'origin' in self.params:
             point = [float(v) for v in self.params['origin'].split(' ')]
             x,y,z = rotate(point, deg)
@@ -240,31 +435,34 @@ class Entity:
             self.params["angles"] = f"{a} {(float(b) - deg) % 360:.0f} {c}"
             # print("debug: after", self.params["angles"])
 
-        return self
-
-    def __str__(self):
-        s = '{\n'
+    def write(self, f):
+        """Writes entity to text file `f`"""
+        f.write('{\n')
 
         fmt_param = lambda k,v: f'"{k}" "{v}"\n'
 
         if 'classname' in self.params:
-            s += fmt_param('classname', self.params['classname'])
+            f.write(fmt_param('classname', self.params['classname']))
 
         for k,v in self.params.items():
             if k == 'classname':
                 continue
 
-            s += fmt_param(k, v)
+            f.write(fmt_param(k, v))
 
         for b in self.brushes:
-            s += str(b) + '\n'
+            f.write(str(b))
+            f.write('\n')
 
-        s += '}\n'
+        f.write('}\n')
 
-        return s
+    def __str__(self):
+        f = io.StringIO()
+        self.write(f)
+        return f.getvalue()
 
     def __repr__(self):
-        return f"<Entity classname={self.params.get('classname', "-")} origin={self.params.get('origin', "-")}>"
+        return f"<Entity classname={self.params.get('classname', '-')} origin={self.params.get('origin', '-')}>"
 
 
 class Map:
@@ -283,113 +481,197 @@ class Map:
         self.entities = entities[:worldspawn_idx] + entities[worldspawn_idx+1:]
 
     def merge(self, other_map):
-        """NOTE: only merges brushes and entities, but ignores worldspawn' params"""
+        """Appends brushes and entities of `other_map` in place.
+
+        NOTE: only merges brushes and entities, but ignores worldspawn' params
+        """
         this_worldspawn  = self.worldspawn      is not None and self.worldspawn.brushes      is not None
         other_worldspawn = other_map.worldspawn is not None and other_map.worldspawn.brushes is not None
         if this_worldspawn and other_worldspawn:
-            self.worldspawn.brushes = self.worldspawn.brushes + other_map.worldspawn.brushes
+            self.worldspawn.brushes.extend(other_map.worldspawn.brushes)
         elif this_worldspawn:
             # we already good, do nothing
             pass
         elif other_worldspawn:
-            self.worldspawn.brushes = other_map.worldspawn.brushes
+            # copy, so merges into this map don't change the other one
+            self.worldspawn.brushes = list(other_map.worldspawn.brushes)
 
         # merge entities
-        self.entities = self.entities + other_map.entities
+        self.entities.extend(other_map.entities)
 
         return self
 
     def move(self, vec):
-        self.worldspawn.move(vec)
+        return self.transform(vec=vec)
 
-        for ent in self.entities:
-            ent.move(vec)
+    def rotate(self, deg):
+        return self.transform(deg=deg)
 
-        return self
+    def transform(self, deg=None, vec=None):
+        """Same as `.rotate(deg).move(vec)`, but faces of all brushes in the map are transformed in one go"""
+        assert deg is None or deg % 90 == 0, 'only right angle rotation is supported'
 
-    def rotate(self, deg):
-        self.worldspawn.rotate(deg)
+        entities = [self.worldspawn, *self.entities]
+        brushes = [b for ent in entities for b in ent.brushes]
 
-        for ent in self.entities:
-            ent.rotate(deg)
+        data = array('d')
+        for b in brushes:
+            data += b.data
+
+        transform_faces(data, deg, vec)
+
+        i = 0
+        for b in brushes:
+            size = len(b.data)
+            b.data[:] = data[i:i+size]
+            b._transform_bbox(deg, vec)
+            i += size
+
+        for ent in entities:
+            if deg is not None:
+                ent.rotate_params(deg)
+            if vec is not None:
+                ent.move_params(vec)
 
         return self
 
     def text(self):
-        return str(self.worldspawn) + ''.join(str(ent) for ent in self.entities)
+        f = io.StringIO()
+        self.write_to(f)
+        return f.getvalue()
 
     def __repr__(self):
         brushes_len = len(self.worldspawn.brushes) \
             if self.worldspawn is not None and self.worldspawn.brushes is not None else None
         return f'<Map brushes={brushes_len} entities={len(self.entities)}>'
 
-    def write(self, filepath):
-        with io.open(filepath, 'w', newline='\r\n') as f:
-            f.write(self.text())
-
-
-def parse_brushes(s):
-    brushes = re.findall(r'^({[\s\S]+?}\s*)', s, re.MULTILINE)
-    # print('groups', brushes)
-    # for x in brushes:
-    #     print(x.strip())
-
-    return [Brush(b.strip()) for b in brushes]
-
-
-def parse_entity(s):
-    # remove outer `{` and `}`
-    s = s[s.find('{')+1:s.rfind('}')].strip()
-    # print('------------------------')
-    # print('parse_entity', s)
-    # print()
+    def write_to(self, f):
+        """Writes map entity by entity to text file `f`, the whole text is never kept in memory"""
+        self.worldspawn.write(f)
+        for ent in self.entities:
+            ent.write(f)
 
-    params = dict()
+    def write(self, filepath):
+        """Saves map to `filepath`, `*.gz` files are compressed with gzip and `-` means stdout"""
+        if filepath == '-':
+            sys.stdout.flush()
+            f = io.TextIOWrapper(sys.stdout.buffer, newline='\r\n')
+            try:
+                self.write_to(f)
+                f.flush()
+            finally:
+                # don't let wrapper close stdout
+                f.detach()
+        elif str(filepath).endswith('.gz'):
+            with gzip.open(filepath, 'wt', newline='\r\n') as f:
+                self.write_to(f)
+        else:
+            with io.open(filepath, 'w', newline='\r\n') as f:
+                self.write_to(f)
+
+
+FACE_NAMES = 'x1 y1 z1 x2 y2 z2 x3 y3 z3 texture tx1 ty1 tz1 offset-x tx2 ty2 tz2 offset-y degree scale-x scale-y'.split()
+
+
+def parse_face(line):
+    """Parses one face line of a brush:
+        ( x1 y1 z1 ) ( x2 y2 z2 ) ( x3 y3 z3 ) TEXTURE [ tx1 ty1 tz1 offset-x ] [ tx2 ty2 tz2 offset-y ] degree scale-x scale-y
+
+    returns texture name and FACE_SIZE number strings in the order of `Brush.data`
+    """
+    m = line.split()
+
+    # Fast path: hammer always puts spaces around brackets, so tokens are at fixed positions
+    if len(m) == 31 and m[0] == '(' and m[16] == '[' and m[27] == ']':
+        return m[15], m[1:4] + m[6:9] + m[11:14] + m[17:21] + m[23:27] + m[28:31]
+
+    m = line.replace('(', '').replace(')', '').replace('[', '').replace(']', '')
+    m = m.split()
+
+    if len(m) != len(FACE_NAMES):
+        log.error("===[ Error ]===")
+        log.error("line: %s", line)
+        log.error("length: %d %d", len(m), len(FACE_NAMES))
+        log.error("m: %s", m)
+        exit(42)
+
+    return m[9], m[:9] + m[10:]
+
+
+def decode_faces(lines):
+    """Face lines of a brush to `Brush.data` and textures"""
+    textures = []
+    values = []
+    for line in lines:
+        texture, face_values = parse_face(line)
+        textures.append(sys.intern(texture))
+        values += face_values
+    return array('d', map(float, values)), tuple(textures)
+
+
+def iter_entities(lines, lazy=False):
+    """Single pass tokenizer over `.map` text, yields every entity as soon as its closing `}` is read.
+
+    `lines` is any iterable of lines: opened file, `io.StringIO`, list of strings...
+    With `lazy` brushes are `LazyBrush`, their faces are decoded only when needed
+    """
+    params = None    # not None while we are inside of an entity
     brushes = None
-    for line in s.split('\n'):
-        if '{' in line:
-            brushes_str = s[s.find('{'):s.rfind('}')+1].strip()
-            brushes = parse_brushes(brushes_str)
-            break
+    textures = None  # not None while we are inside of a brush
+    values = None
+    face_lines = None
 
-        key, value = line.strip()[1:-1].split('" "')
-        params[key] = value
-    return Entity(params, brushes)
-
-
-def parse_map(_map):
-    if isinstance(_map, io.IOBase):
-        tmp = _map.read()
-        _map.close()
-        _map = tmp
-
-    _map = _map.strip()
-
-    entities = list()
-
-    buf = ''
-    depth = 0
-    for raw_line in _map.split('\n'):
+    for raw_line in lines:
         line = raw_line.strip()
-        if line == '{':
-            depth += 1
+        if not line:
+            continue
+
+        if textures is not None:
+            if line == '}':
+                if lazy:
+                    brushes.append(LazyBrush(face_lines))
+                else:
+                    brushes.append(Brush(array('d', map(float, values)), tuple(textures)))
+                textures = None
+                values = None
+                face_lines = None
+            elif lazy:
+                face_lines.append(line)
+            else:
+                texture, face_values = parse_face(line)
+                textures.append(sys.intern(texture))
+                values += face_values
+        elif line == '{':
+            if params is None:
+                params = dict()
+                brushes = list()
+            else:
+                textures = list()
+                values = list()
+                face_lines = list()
+        elif params is None:
+            # garbage between entities
+            continue
         elif line == '}':
-            if depth == 1:
-                buf += raw_line + '\n'
-                ent = parse_entity(buf)
-                entities.append(ent)
+            yield Entity(params, brushes)
+            params = None
+            brushes = None
+        else:
+            key, value = line[1:-1].split('" "')
+            params[key] = value
 
 
-                # reset
-                buf = ''
-                depth = 0
-                continue
+def parse_entity(s):
+    return next(iter_entities(io.StringIO(s)))
 
-            depth -= 1
 
-        buf += raw_line + '\n'
+def parse_map(_map, lazy=False):
+    """Parses map from opened file or string, see `iter_entities()` for `lazy`"""
+    if isinstance(_map, io.IOBase):
+        with _map:
+            return Map(list(iter_entities(_map, lazy)))
 
-    return Map(entities)
+    return Map(list(iter_entities(io.StringIO(_map), lazy)))
 
 
 if __name__ == '__main__':
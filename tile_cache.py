@@ -0,0 +1,121 @@
+"""On-disk cache of parsed (and sliced) tiles.
+
+Cache entries are pickles keyed by the content of source `.map` files and by the
+version of generator code, so changing either of them invalidates the entry.
+"""
+import hashlib
+import logging
+import os
+import pickle
+import re
+from functools import lru_cache
+from pathlib import Path
+
+import instrument
+import map_parser as p
+
+log = logging.getLogger(__name__)
+
+ENABLED = True
+CACHE_DIR = Path(".tile_cache")
+
+# Code that produces cached data, any change in these files invalidates the cache
+CODE_FILES = ["map_parser.py", "map_gen_v2.py", "tile_cache.py"]
+
+
+@lru_cache(maxsize=None)
+def generator_version():
+    h = hashlib.sha256()
+    for name in CODE_FILES:
+        h.update((Path(__file__).parent / name).read_bytes())
+    return h.hexdigest()
+
+
+def _slug(path):
+    return re.sub(r'[^A-Za-z0-9_.-]+', '_', str(path)).strip('_')
+
+
+def _dependencies_hash(sources):
+    h = hashlib.sha256(generator_version().encode())
+    for path in sources:
+        h.update(str(path).encode())
+        h.update(Path(path).read_bytes())
+    return h.hexdigest()
+
+
+def cached(kind, sources, build):
+    """Returns result of `build()`, which is loaded from the cache if none of `sources` (paths) changed"""
+    if not ENABLED:
+        return build()
+
+    prefix = f"{kind}-{_slug(sources[0])}-"
+    cache_path = CACHE_DIR / f"{prefix}{_dependencies_hash(sources)[:16]}.pickle"
+
+    if cache_path.exists():
+        try:
+            with open(cache_path, 'rb') as f:
+                return pickle.load(f)
+        except Exception as e:
+            log.warning("broken tile cache %s: %s", cache_path, e)
+
+    result = build()
+
+    CACHE_DIR.mkdir(exist_ok=True)
+    # remove outdated entries of the same source
+    for old_path in CACHE_DIR.glob(f"{prefix}*.pickle"):
+        old_path.unlink(missing_ok=True)
+
+    # write to temporary file first, so parallel runs never see half-written cache
+    tmp_path = cache_path.with_suffix(f'.{os.getpid()}.tmp')
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, cache_path)
+
+    return result
+
+
+def _last_path(kind, path):
+    return CACHE_DIR / f"{kind}-{_slug(path)}-last.pickle"
+
+
+def load_last(kind, path, depends=()):
+    """Returns value last saved by `save_last()` for `path` (even if the file changed since),
+    None if there is none or files in `depends` (or the code) changed
+    """
+    if not ENABLED:
+        return None
+
+    try:
+        with open(_last_path(kind, path), 'rb') as f:
+            dependencies_hash, value = pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        log.warning("broken tile cache %s: %s", _last_path(kind, path), e)
+        return None
+
+    if dependencies_hash != _dependencies_hash(depends):
+        return None
+    return value
+
+
+def save_last(kind, path, value, depends=()):
+    """Saves `value` for `path`, see `load_last()`"""
+    if not ENABLED:
+        return
+
+    CACHE_DIR.mkdir(exist_ok=True)
+    last_path = _last_path(kind, path)
+    tmp_path = last_path.with_suffix(f'.{os.getpid()}.tmp')
+    with open(tmp_path, 'wb') as f:
+        pickle.dump((_dependencies_hash(depends), value), f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, last_path)
+
+
+def parse_map(path, lazy=False):
+    """Same as `map_parser.parse_map(open(path), lazy)`, but cached"""
+    def build():
+        with instrument.timer("parse"):
+            return p.parse_map(open(path), lazy)
+
+    return cached("map-lazy" if lazy else "map", [path], build)